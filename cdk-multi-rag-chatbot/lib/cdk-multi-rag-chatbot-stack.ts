@@ -31,7 +31,7 @@ const enableReference = 'true';
 let opensearch_url = "";
 const debugMessageMode = 'false'; // if true, debug messages will be delivered to the client.
 const useParallelUpload = 'true';
-const useParallelRAG = 'false';
+const useParallelRAG = 'true';
 const numberOfRelevantDocs = '8';
 
 const claude3_sonnet = [
@@ -181,6 +181,16 @@ export class CdkMultiRagChatbotStack extends cdk.Stack {
       indexName: callLogIndexName,
       partitionKey: { name: 'request_id', type: dynamodb.AttributeType.STRING },
     });
+
+    // DynamoDB for retrieval cache
+    const retrievalCacheTableName = `db-retrieval-cache-for-${projectName}`;
+    const retrievalCacheTable = new dynamodb.Table(this, `db-retrieval-cache-for-${projectName}`, {
+      tableName: retrievalCacheTableName,
+      partitionKey: { name: 'cache_key', type: dynamodb.AttributeType.STRING },
+      timeToLiveAttribute: 'ttl',
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
     
     // Lambda - chat (websocket)
     const roleLambdaWebsocket = new iam.Role(this, `role-lambda-chat-ws-for-${projectName}`, {
@@ -609,6 +619,7 @@ export class CdkMultiRagChatbotStack extends cdk.Stack {
       code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../../lambda-chat-ws')),
       timeout: cdk.Duration.seconds(300),
       memorySize: 8192,
+      ephemeralStorageSize: cdk.Size.gibibytes(4), // /tmp has documents, faiss snapshots and the embedding cache
       role: roleLambdaWebsocket,
       environment: {
         // bedrock_region: bedrock_region,
@@ -617,6 +628,7 @@ export class CdkMultiRagChatbotStack extends cdk.Stack {
         s3_bucket: s3Bucket.bucketName,
         s3_prefix: s3_prefix,
         callLogTableName: callLogTableName,
+        retrievalCacheTableName: retrievalCacheTableName,
         connection_url: connection_url,
         enableReference: enableReference,
         opensearch_account: opensearch_account,
@@ -636,6 +648,7 @@ export class CdkMultiRagChatbotStack extends cdk.Stack {
     lambdaChatWebsocket.grantInvoke(new iam.ServicePrincipal('apigateway.amazonaws.com'));  
     s3Bucket.grantReadWrite(lambdaChatWebsocket); // permission for s3
     callLogDataTable.grantReadWriteData(lambdaChatWebsocket); // permission for dynamo 
+    retrievalCacheTable.grantReadWriteData(lambdaChatWebsocket); // permission for retrieval cache
     
     if(debug) {
       new cdk.CfnOutput(this, 'function-chat-ws-arn', {
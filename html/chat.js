@@ -61,6 +61,7 @@ let maxMsgItems = 200;
 let sentTime = new HashMap();
 
 let undelivered = new HashMap();
+let streamedMsg = new HashMap();
 let retry_count = 0;
 function sendMessage(message) {
     if(!isConnected) {
@@ -102,7 +103,9 @@ function pong() {
 }
 
 function connect(endpoint, type) {
-    const ws = new WebSocket(endpoint);
+    // the user is given on connect, so that the server can prepare the memory of the user in advance
+    let user_id = localStorage.getItem('userId');
+    const ws = new WebSocket(user_id? endpoint+'?user_id='+encodeURIComponent(user_id): endpoint);
 
     // connection event
     ws.onopen = function () {
@@ -154,8 +157,15 @@ function connect(endpoint, type) {
                 if(response.status == 'completed') {          
                     feedback.style.display = 'none';          
                     console.log('received message: ', response.msg);                  
+                    streamedMsg.remove(response.request_id);
                     addReceivedMessage(response.request_id, response.msg);  
                 }                
+                else if(response.status == 'delta') {
+                    feedback.style.display = 'none';
+                    let msg = (streamedMsg.get(response.request_id) || "") + response.msg;
+                    streamedMsg.put(response.request_id, msg);
+                    addReceivedMessage(response.request_id, msg);  
+                }                
                 else if(response.status == 'istyping') {
                     feedback.style.display = 'inline';
                     // feedback.innerHTML = '<i>typing a message...</i>'; 
@@ -1,33 +1,71 @@
-import json
-import boto3
-import os
 import time
-import datetime
-from io import BytesIO
-import PyPDF2
-import csv
-import traceback
-import re
-from urllib import parse
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain.chains.summarize import load_summarize_chain
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from botocore.config import Config
-
-from langchain.vectorstores.faiss import FAISS
-from langchain.vectorstores.opensearch_vector_search import OpenSearchVectorSearch
-from langchain.embeddings import BedrockEmbeddings
-from langchain.retrievers import AmazonKendraRetriever
-from multiprocessing import Process, Pipe
-
-from langchain_community.chat_models import BedrockChat
-from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
-
-s3 = boto3.client('s3')
+from contextlib import contextmanager
+
+# cold-start profiler: the time of imports and initializers at INIT is recorded and reported at the end of INIT.
+# Modules which are not needed by every request (documents, faiss, opensearch and kendra) are imported lazily.
+init_start_time = time.time()
+init_profile = []   # (name, seconds)
+
+@contextmanager
+def init_profiler(name):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        elapsed_time = time.time() - start_time
+        if init_start_time is None:  # lazily loaded after INIT
+            print(f'lazy init of {name}: {elapsed_time:.3f}s')
+        else:
+            init_profile.append((name, elapsed_time))
+
+def print_init_profile():
+    global init_start_time
+    total = time.time() - init_start_time
+    print(f'init duration: {total:.3f}s')
+    for name, elapsed_time in sorted(init_profile, key=lambda x: -x[1]):
+        print(f' - {name}: {elapsed_time:.3f}s ({100*elapsed_time/total:.1f}%)')
+    init_start_time = None
+
+with init_profiler('stdlib'):
+    import json
+    import os
+    import datetime
+    import csv
+    import io
+    import traceback
+    import re
+    import threading
+    import itertools
+    import queue
+    import hashlib
+    import mmap
+    import struct
+    import shutil
+    import uuid
+    from collections import deque, OrderedDict
+    from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+    from urllib import parse
+
+with init_profiler('boto3'):
+    import boto3
+    from botocore.config import Config
+
+with init_profiler('numpy'):
+    import numpy as np
+
+with init_profiler('langchain'):
+    from langchain.docstore.document import Document
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
+
+with init_profiler('langchain bedrock'):
+    from langchain.embeddings import BedrockEmbeddings
+    from langchain_community.chat_models import BedrockChat
+
+with init_profiler('s3 client'):
+    s3 = boto3.client('s3')
 s3_bucket = os.environ.get('s3_bucket') # bucket name
 s3_prefix = os.environ.get('s3_prefix')
 callLogTableName = os.environ.get('callLogTableName')
@@ -44,7 +82,7 @@ debugMessageMode = os.environ.get('debugMessageMode', 'false')
 opensearch_url = os.environ.get('opensearch_url')
 path = os.environ.get('path')
 useParallelUpload = os.environ.get('useParallelUpload', 'false')
-useParallelRAG = os.environ.get('useParallelRAG', 'false')
+useParallelRAG = os.environ.get('useParallelRAG', 'true')
 kendraIndex = os.environ.get('kendraIndex')
 kendra_method = "kendra_retriever" # custom_retriever or kendra_retriever
 roleArn = os.environ.get('roleArn')
@@ -53,79 +91,529 @@ top_k = int(numberOfRelevantDocs)
 selected_LLM = 0
 capabilities = json.loads(os.environ.get('capabilities'))
 print('capabilities: ', capabilities)
-MSG_LENGTH = 100
+STREAM_FLUSH_INTERVAL = float(os.environ.get('streamFlushInterval', '0.05')) # seconds
+STREAM_FLUSH_SIZE = int(os.environ.get('streamFlushSize', '64'))  # characters
 
 # websocket
 connection_url = os.environ.get('connection_url')
-client = boto3.client('apigatewaymanagementapi', endpoint_url=connection_url)
+with init_profiler('websocket client'):
+    client = boto3.client('apigatewaymanagementapi', endpoint_url=connection_url)
 print('connection_url: ', connection_url)
 
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+
 HUMAN_PROMPT = "\n\nHuman:"
 AI_PROMPT = "\n\nAssistant:"
 
-map_chain = dict() 
+# bedrock clients are pooled per region in a warm container. Chat models fail over by the router, so their client
+# doesn't retry, but embeddings are not routed and their client keeps the retries of botocore for throttling.
+BEDROCK_MAX_POOL_CONNECTIONS = 50
+BEDROCK_MAX_RETRIES = 1
+BEDROCK_EMBEDDING_MAX_RETRIES = 30
+bedrock_lock = threading.Lock()
+map_bedrock_client = dict()    # (bedrock_region, max_attempts) -> bedrock-runtime client
+map_chat_model = dict()        # (bedrock_region, modelId) -> BedrockChat
+map_embedding_model = dict()   # (bedrock_region, modelId) -> BedrockEmbeddings
+
+def get_bedrock_client(bedrock_region, max_attempts=BEDROCK_MAX_RETRIES):
+    key = (bedrock_region, max_attempts)
+    boto3_bedrock = map_bedrock_client.get(key)
+    if boto3_bedrock is None:
+        with bedrock_lock:
+            boto3_bedrock = map_bedrock_client.get(key)
+            if boto3_bedrock is None:
+                print('create bedrock client for ', bedrock_region)
+                boto3_bedrock = boto3.client(
+                    service_name='bedrock-runtime',
+                    region_name=bedrock_region,
+                    config=Config(
+                        retries = {
+                            'max_attempts': max_attempts
+                        },
+                        max_pool_connections = BEDROCK_MAX_POOL_CONNECTIONS
+                    )
+                )
+                map_bedrock_client[key] = boto3_bedrock
+    return boto3_bedrock
 
 def get_chat(profile_of_LLMs, selected_LLM):
     profile = profile_of_LLMs[selected_LLM]
     bedrock_region =  profile['bedrock_region']
     modelId = profile['model_id']
     print(f'LLM: {selected_LLM}, bedrock_region: {bedrock_region}, modelId: {modelId}')
-    maxOutputTokens = int(profile['maxOutputTokens'])
-                          
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }            
-        )
-    )
-    parameters = {
-        "max_tokens":maxOutputTokens,     
-        "temperature":0.1,
-        "top_k":250,
-        "top_p":0.9,
-        "stop_sequences": [HUMAN_PROMPT]
-    }
-    # print('parameters: ', parameters)
 
-    chat = BedrockChat(
-        model_id=modelId,
-        client=boto3_bedrock, 
-        streaming=True,
-        callbacks=[StreamingStdOutCallbackHandler()],
-        model_kwargs=parameters,
-    )        
+    key = (bedrock_region, modelId)
+    chat = map_chat_model.get(key)
+    if chat is None:
+        maxOutputTokens = int(profile['maxOutputTokens'])
+        parameters = {
+            "max_tokens":maxOutputTokens,     
+            "temperature":0.1,
+            "top_k":250,
+            "top_p":0.9,
+            "stop_sequences": [HUMAN_PROMPT]
+        }
+        # print('parameters: ', parameters)
+
+        boto3_bedrock = get_bedrock_client(bedrock_region)
+        with bedrock_lock:
+            chat = map_chat_model.get(key)
+            if chat is None:
+                chat = BedrockChat(
+                    model_id=modelId,
+                    client=boto3_bedrock, 
+                    streaming=True,
+                    callbacks=[StreamingStdOutCallbackHandler()],
+                    model_kwargs=parameters,
+                )
+                map_chat_model[key] = chat
     
     return chat
 
 def get_embedding(profile_of_LLMs, selected_LLM):
     profile = profile_of_LLMs[selected_LLM]
     bedrock_region =  profile['bedrock_region']
-    modelId = profile['model_id']
+    modelId = EMBEDDING_MODEL_ID
     print(f'Embedding: {selected_LLM}, bedrock_region: {bedrock_region}, modelId: {modelId}')
     
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }            
-        )
-    )
-    
-    bedrock_embedding = BedrockEmbeddings(
-        client=boto3_bedrock,
-        region_name = bedrock_region,
-        model_id = 'amazon.titan-embed-text-v1' 
-    )  
+    key = (bedrock_region, modelId)
+    bedrock_embedding = map_embedding_model.get(key)
+    if bedrock_embedding is None:
+        boto3_bedrock = get_bedrock_client(bedrock_region, BEDROCK_EMBEDDING_MAX_RETRIES)
+        with bedrock_lock:
+            bedrock_embedding = map_embedding_model.get(key)
+            if bedrock_embedding is None:
+                bedrock_embedding = CachedEmbeddings(
+                    BedrockEmbeddings(
+                        client=boto3_bedrock,
+                        region_name = bedrock_region,
+                        model_id = modelId
+                    )
+                )  
+                map_embedding_model[key] = bedrock_embedding
     
     return bedrock_embedding
 
+# embedding cache: the key is the hash of model id and text. Vectors are kept in a LRU which is bounded by bytes,
+# and optionally in a memory-mapped file in /tmp which survives warm invocations
+EMBEDDING_CACHE_SIZE = int(os.environ.get('embeddingCacheSize', '64'))*1024*1024  # bytes
+enableEmbeddingDiskCache = os.environ.get('enableEmbeddingDiskCache', 'true')
+EMBEDDING_DISK_CACHE_SIZE = int(os.environ.get('embeddingDiskCacheSize', '128'))*1024*1024  # bytes, /tmp is shared with documents and faiss snapshots
+EMBEDDING_DISK_CACHE_PATH = '/tmp/embedding-cache'
+EMBEDDING_KEY_SIZE = 32   # sha256
+EMBEDDING_HEADER_SIZE = 4
+embedding_cache_lock = threading.Lock()
+embedding_cache = OrderedDict()   # key -> vector (float32)
+embedding_cache_bytes = 0
+map_embedding_disk_cache = dict()  # modelId -> disk tier
+embedding_cache_counter = {
+    'hit': 0,
+    'disk_hit': 0,
+    'miss': 0
+}
+
+def get_embedding_key(modelId, text):
+    return hashlib.sha256((modelId+'\n'+text).encode('utf-8')).digest()
+
+def put_embedding_to_memory(key, vector):
+    global embedding_cache_bytes
+    if key in embedding_cache:
+        embedding_cache.move_to_end(key)
+        return
+    embedding_cache[key] = vector
+    embedding_cache_bytes += vector.nbytes + EMBEDDING_KEY_SIZE
+    while embedding_cache_bytes > EMBEDDING_CACHE_SIZE and embedding_cache:
+        _, evicted = embedding_cache.popitem(last=False)
+        embedding_cache_bytes -= evicted.nbytes + EMBEDDING_KEY_SIZE
+
+def get_embedding_disk_cache(modelId, dimension=None):
+    # the file has a header of the dimension (uint32) and records of [key(32 bytes), vector(float32 x dimension)]
+    disk_cache = map_embedding_disk_cache.get(modelId)
+    if disk_cache is None:
+        filename = os.path.join(EMBEDDING_DISK_CACHE_PATH, modelId.replace(':', '_')+'.bin')
+        if not os.path.exists(filename):
+            if dimension is None:
+                return None
+            os.makedirs(EMBEDDING_DISK_CACHE_PATH, exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(struct.pack('<I', dimension))
+        
+        with open(filename, 'rb') as f:
+            stored_dimension = struct.unpack('<I', f.read(EMBEDDING_HEADER_SIZE))[0]
+            record_size = EMBEDDING_KEY_SIZE + 4*stored_dimension
+            size = EMBEDDING_HEADER_SIZE + (os.path.getsize(filename)-EMBEDDING_HEADER_SIZE) // record_size * record_size
+            
+            index = dict()
+            if os.path.getsize(filename) > size:  # a partial record of an interrupted write is dropped, so records are appended at size
+                print('embedding disk cache has a partial record. truncate to ', size)
+                os.truncate(filename, size)
+            for offset in range(EMBEDDING_HEADER_SIZE, size, record_size):
+                f.seek(offset)
+                index[f.read(EMBEDDING_KEY_SIZE)] = offset + EMBEDDING_KEY_SIZE
+        print(f'embedding disk cache: {filename}, records: {len(index)}')
+
+        disk_cache = {
+            'filename': filename,
+            'dimension': stored_dimension,
+            'record_size': record_size,
+            'index': index,      # key -> offset of vector
+            'size': size,
+            'mm': None,
+            'mapped_size': 0
+        }
+        map_embedding_disk_cache[modelId] = disk_cache
+    
+    if dimension is not None and disk_cache['dimension'] != dimension:
+        print('dimension of embedding was changed. start over the disk cache')
+        reset_embedding_disk_cache(disk_cache, dimension)
+    return disk_cache
+
+def reset_embedding_disk_cache(disk_cache, dimension):
+    if disk_cache['mm'] is not None:
+        disk_cache['mm'].close()
+    with open(disk_cache['filename'], 'wb') as f:
+        f.write(struct.pack('<I', dimension))
+    disk_cache.update({
+        'dimension': dimension,
+        'record_size': EMBEDDING_KEY_SIZE + 4*dimension,
+        'index': dict(),
+        'size': EMBEDDING_HEADER_SIZE,
+        'mm': None,
+        'mapped_size': 0
+    })
+
+def get_embedding_from_disk(modelId, key):
+    try:
+        disk_cache = get_embedding_disk_cache(modelId)
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return None
+    if disk_cache is None:
+        return None
+    
+    offset = disk_cache['index'].get(key)
+    if offset is None:
+        return None
+    
+    if disk_cache['mapped_size'] < disk_cache['size']:  # the file was appended after mapping
+        if disk_cache['mm'] is not None:
+            disk_cache['mm'].close()
+        with open(disk_cache['filename'], 'rb') as f:
+            disk_cache['mm'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        disk_cache['mapped_size'] = disk_cache['size']
+    
+    return np.frombuffer(disk_cache['mm'], dtype=np.float32, count=disk_cache['dimension'], offset=offset).copy()
+
+def put_embeddings_to_disk(disk_cache, items):
+    if disk_cache['size'] + disk_cache['record_size']*len(items) > EMBEDDING_DISK_CACHE_SIZE:
+        print('embedding disk cache is full. start over')
+        reset_embedding_disk_cache(disk_cache, disk_cache['dimension'])
+
+    records = dict()
+    for key, vector in items:
+        if key not in disk_cache['index']:
+            records[key] = vector.tobytes()
+    if not records:
+        return
+
+    # the index is updated only after the records were written, and the tier starts over if the write fails (e.g. ENOSPC)
+    try:
+        with open(disk_cache['filename'], 'r+b') as f:
+            f.seek(disk_cache['size'])
+            f.write(b''.join(key + vector for key, vector in records.items()))
+            f.flush()
+    except Exception:
+        reset_embedding_disk_cache(disk_cache, disk_cache['dimension'])
+        raise
+    
+    for key in records:
+        disk_cache['index'][key] = disk_cache['size'] + EMBEDDING_KEY_SIZE
+        disk_cache['size'] += disk_cache['record_size']
+
+def get_cached_embeddings(bedrock_embedding, modelId, texts):
+    """Returns float32 vectors of texts. Only texts which are not in the cache are embedded by Bedrock."""
+    keys = [get_embedding_key(modelId, text) for text in texts]
+    vectors = dict()
+    with embedding_cache_lock:
+        for key in keys:
+            if key in vectors:
+                continue
+            vector = embedding_cache.get(key)
+            if vector is not None:
+                embedding_cache.move_to_end(key)
+                vectors[key] = vector
+                embedding_cache_counter['hit'] += 1
+                continue
+            
+            if enableEmbeddingDiskCache == 'true':
+                vector = get_embedding_from_disk(modelId, key)
+                if vector is not None:
+                    put_embedding_to_memory(key, vector)
+                    vectors[key] = vector
+                    embedding_cache_counter['disk_hit'] += 1
+
+    missing = dict()  # key -> text
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    
+    if missing:
+        new_vectors = bedrock_embedding.embed_documents(list(missing.values()))
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in zip(missing.keys(), new_vectors)]
+        
+        with embedding_cache_lock:
+            embedding_cache_counter['miss'] += len(items)
+            for key, vector in items:
+                put_embedding_to_memory(key, vector)
+                vectors[key] = vector
+            
+            if enableEmbeddingDiskCache == 'true':
+                try:
+                    disk_cache = get_embedding_disk_cache(modelId, len(items[0][1]))
+                    put_embeddings_to_disk(disk_cache, items)
+                except Exception:
+                    err_msg = traceback.format_exc()
+                    print('error message: ', err_msg)
+    
+    print(f'embeddings: {len(texts)}, new: {len(missing)}, cache: {embedding_cache_counter}, bytes: {embedding_cache_bytes}')
+    return [vectors[key] for key in keys]
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings which are served from the embedding cache before calling Bedrock."""
+    def __init__(self, bedrock_embedding):
+        self.bedrock_embedding = bedrock_embedding
+        self.model_id = bedrock_embedding.model_id
+
+    def embed_documents(self, texts):
+        return [vector.tolist() for vector in get_cached_embeddings(self.bedrock_embedding, self.model_id, texts)]
+
+    def embed_query(self, text):
+        return get_cached_embeddings(self.bedrock_embedding, self.model_id, [text])[0].tolist()
+
+    def embed_documents_as_array(self, texts):
+        return np.vstack(get_cached_embeddings(self.bedrock_embedding, self.model_id, texts))
+
+    def embed_query_as_array(self, text):
+        return get_cached_embeddings(self.bedrock_embedding, self.model_id, [text])[0]
+
+# multi-region router: the best healthy region is selected by EWMA of time-to-first-token and error rate
+ROUTER_EWMA_ALPHA = 0.3
+ROUTER_ERROR_PENALTY = 4     # weight of the error rate on the latency score
+ROUTER_COOLDOWN = float(os.environ.get('routerCooldown', '10'))  # seconds that a throttled region is skipped
+LLM_MAX_ATTEMPTS = max(3, len(profile_of_LLMs)+1)
+router_lock = threading.Lock()
+map_region_status = dict()   # index of profile_of_LLMs -> status of the region
+
+def get_region_status(index):
+    if index not in map_region_status:
+        map_region_status[index] = {
+            'ttft': None,           # EWMA of time to first token (sec)
+            'error_rate': 0.0,      # EWMA of error/throttle rate
+            'requests': 0,
+            'throttled': 0,
+            'cooldown_until': 0.0,
+            'samples': deque(maxlen=HEDGING_SAMPLES)  # recent time to first tokens
+        }
+    return map_region_status[index]
+
+def select_LLM(excluded=None):
+    global selected_LLM
+    
+    if excluded is None:
+        excluded = []
+    now = time.time()
+    with router_lock:
+        candidates = [i for i in range(len(profile_of_LLMs)) if i not in excluded]
+        if not candidates:
+            return None
+        
+        healthy = [i for i in candidates if get_region_status(i)['cooldown_until'] <= now]
+        if not healthy:  # every region is cooling down, so use the one which recovers first
+            index = min(candidates, key=lambda i: get_region_status(i)['cooldown_until'])
+        else:
+            def score(i):
+                status = get_region_status(i)
+                if status['ttft'] is None:  # not measured yet
+                    latency = 0.0
+                else:
+                    latency = status['ttft'] * (1 + ROUTER_ERROR_PENALTY*status['error_rate'])
+                return (latency, (i - selected_LLM - 1) % len(profile_of_LLMs))  # ties are rotated
+            index = min(healthy, key=score)
+        
+        selected_LLM = index
+    return index
+
+def record_LLM_success(index, time_to_first_token):
+    with router_lock:
+        status = get_region_status(index)
+        status['requests'] += 1
+        status['samples'].append(time_to_first_token)
+        if status['ttft'] is None:
+            status['ttft'] = time_to_first_token
+        else:
+            status['ttft'] = ROUTER_EWMA_ALPHA*time_to_first_token + (1-ROUTER_EWMA_ALPHA)*status['ttft']
+        status['error_rate'] = (1-ROUTER_EWMA_ALPHA)*status['error_rate']
+
+def record_LLM_failure(index, throttled):
+    with router_lock:
+        status = get_region_status(index)
+        status['requests'] += 1
+        status['error_rate'] = ROUTER_EWMA_ALPHA + (1-ROUTER_EWMA_ALPHA)*status['error_rate']
+        if throttled:
+            status['throttled'] += 1
+            status['cooldown_until'] = time.time() + ROUTER_COOLDOWN
+        print(f'LLM: {index}, region status: {status}')
+
+def isThrottlingError(err):
+    err_msg = str(err)
+    return 'ThrottlingException' in err_msg or 'Too many requests' in err_msg or 'TooManyRequests' in err_msg
+
+def read_first_token(stream):
+    for chunk in stream:
+        if chunk.content:
+            return chunk
+    return None
+
+def open_LLM_stream(index, prompt, inputs):
+    chat = get_chat(profile_of_LLMs, index)
+    chain = prompt | chat
+    start_time = time.time()
+    try:
+        stream = iter(chain.stream(inputs))
+        first = read_first_token(stream)
+    except Exception as err:
+        throttled = isThrottlingError(err)
+        record_LLM_failure(index, throttled)
+        print(f'LLM: {index} failed (throttled: {throttled}), err: {err}')
+        raise
+
+    record_LLM_success(index, time.time() - start_time)
+    return chat, first, stream
+
+def stream_from_LLM(prompt, inputs, hedging=False, preferred=None):
+    """Streams prompt|chat from the best region, or from the preferred region if it is healthy. Until the first 
+    token arrives, a failed region is recorded and the request fails over to the next one. Returns the chat and the token stream."""
+    if hedging and enableHedging == 'true' and len(profile_of_LLMs) >= 2:
+        return hedged_stream_from_LLM(prompt, inputs)
+
+    excluded = []
+    last_err = None
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        if attempt == 0 and preferred is not None and get_region_status(preferred)['cooldown_until'] <= time.time():
+            index = preferred
+        else:
+            index = select_LLM(excluded)
+        if index is None:  # every region was tried, so start over from the best one
+            excluded = []
+            index = select_LLM(excluded)
+        
+        waiting_time = get_region_status(index)['cooldown_until'] - time.time()
+        if waiting_time > 0:
+            print(f'every region is throttled. wait {waiting_time:.1f}s for LLM: {index}')
+            time.sleep(waiting_time)
+
+        try:
+            chat, first, stream = open_LLM_stream(index, prompt, inputs)
+        except Exception as err:
+            last_err = err
+            print(f'LLM: {index}, attempt: {attempt+1}')
+            excluded.append(index)
+            continue
+
+        if first is None:
+            return chat, iter([])
+        return chat, itertools.chain([first], stream)
+    
+    raise last_err
+
+# hedging: if the first region has no token within the budget, the same request is sent to the next region
+enableHedging = os.environ.get('enableHedging', 'false')
+HEDGING_PERCENTILE = float(os.environ.get('hedgingPercentile', '95'))  # percentile of time to first token
+HEDGING_DELAY = float(os.environ.get('hedgingDelay', '3'))  # seconds, used until enough samples are collected
+HEDGING_MIN_DELAY = 0.2
+HEDGING_SAMPLES = 100
+HEDGING_MIN_SAMPLES = 10
+hedging_counter = {
+    'requests': 0,
+    'fired': 0,   # a hedged request was sent 
+    'won': 0,     # the hedged request produced the first token before the original one
+}
+
+def get_hedging_budget(index):
+    with router_lock:
+        samples = sorted(get_region_status(index)['samples'])
+    if len(samples) < HEDGING_MIN_SAMPLES:
+        return HEDGING_DELAY
+    
+    position = min(len(samples)-1, int(len(samples)*HEDGING_PERCENTILE/100))
+    return max(HEDGING_MIN_DELAY, samples[position])
+
+def hedged_stream_from_LLM(prompt, inputs):
+    primary = select_LLM()
+    secondary = select_LLM([primary])
+    if get_region_status(primary)['cooldown_until'] > time.time():  # every region is throttled
+        return stream_from_LLM(prompt, inputs)
+
+    budget = get_hedging_budget(primary)
+    results = queue.Queue()
+    winner = []
+    winner_lock = threading.Lock()
+
+    def hedge_worker(index, is_hedge):
+        try:
+            chat, first, stream = open_LLM_stream(index, prompt, inputs)
+        except Exception as err:
+            results.put((index, is_hedge, None, err))
+            return
+        
+        with winner_lock:
+            isWinner = not winner
+            if isWinner:
+                winner.append(index)
+        if isWinner:
+            results.put((index, is_hedge, (chat, first, stream), None))
+        else:  # cancel the slower one
+            print(f'LLM: {index} lost the hedged request. close the stream')
+            stream.close()
+
+    with router_lock:
+        hedging_counter['requests'] += 1
+    threading.Thread(target=hedge_worker, args=(primary, False), daemon=True).start()
+    pending = 1
+    isHedged = False
+    while pending:
+        try:
+            index, is_hedge, result, err = results.get(timeout=None if isHedged else budget)
+        except queue.Empty:  
+            print(f'no token from LLM: {primary} in {budget:.2f}s. send the hedged request to LLM: {secondary}')
+            with router_lock:
+                hedging_counter['fired'] += 1
+            threading.Thread(target=hedge_worker, args=(secondary, True), daemon=True).start()
+            pending += 1
+            isHedged = True
+            continue
+        
+        pending -= 1
+        if err is None:
+            chat, first, stream = result
+            if is_hedge:
+                with router_lock:
+                    hedging_counter['won'] += 1
+            print(f'LLM: {index} won, hedging counter: {hedging_counter}')
+            
+            if first is None:
+                return chat, iter([])
+            return chat, itertools.chain([first], stream)
+        
+        if not isHedged:  # the original request failed before the budget, so fail over at once
+            threading.Thread(target=hedge_worker, args=(secondary, True), daemon=True).start()
+            pending += 1
+            isHedged = True
+    
+    print('both of hedged requests failed')
+    return stream_from_LLM(prompt, inputs)
+
 def sendMessage(id, body):
     try:
         client.post_to_connection(
@@ -164,7 +652,7 @@ def sendErrorMessage(connectionId, requestId, msg):
     print('error: ', json.dumps(errorMsg))
     sendMessage(connectionId, errorMsg)
 
-def general_conversation(connectionId, requestId, chat, query):
+def general_conversation(connectionId, requestId, query):
     global time_for_inference, history_length, token_counter_history    
     time_for_inference = history_length = token_counter_history = 0
     
@@ -182,25 +670,28 @@ def general_conversation(connectionId, requestId, chat, query):
     
     human = "{input}"
     
-    prompt = ChatPromptTemplate.from_messages([("system", system), MessagesPlaceholder(variable_name="history"), ("human", human)])
-    print('prompt: ', prompt)
-    
-    history = memory_chain.load_memory_variables({})["chat_history"]
+    summary, history = get_history(memory_entry)
     print('memory_chain: ', history)
+    
+    prompt = ChatPromptTemplate.from_messages([("system", get_history_prompt(summary, system)), MessagesPlaceholder(variable_name="history"), ("human", human)])
+    print('prompt: ', prompt)
+    count_tokens('prompt', system, query)
                 
-    chain = prompt | chat    
     try: 
         isTyping(connectionId, requestId)  
-        stream = chain.invoke(
+        start_time = time.time()
+        chat, stream = stream_from_LLM(
+            prompt, 
             {
                 "history": history,
                 "input": query,
-            }
+                "summary": summary
+            },
+            hedging=True
         )
-        msg = readStreamMsg(connectionId, requestId, stream.content)    
-                            
-        msg = stream.content
+        msg = readStreamMsg(connectionId, requestId, stream, start_time)    
         print('msg: ', msg)
+        count_tokens('completion', msg)
     except Exception:
         err_msg = traceback.format_exc()
         print('error message: ', err_msg)        
@@ -208,23 +699,11 @@ def general_conversation(connectionId, requestId, chat, query):
         sendErrorMessage(connectionId, requestId, err_msg)    
         raise Exception ("Not able to request to LLM")
 
+    history_length = len(summary) + sum(len(str(dialogue_turn.content)) for dialogue_turn in history)
+    token_counter_history = token_usage['history']
+    print(f'chat_history length: {history_length}, token_size of history: {token_counter_history}')
+    
     if debugMessageMode == 'true':  
-        chat_history = ""
-        for dialogue_turn in history:
-            #print('type: ', dialogue_turn.type)
-            #print('content: ', dialogue_turn.content)
-            
-            dialog = f"{dialogue_turn.type}: {dialogue_turn.content}\n"            
-            chat_history = chat_history + dialog
-                
-        history_length = len(chat_history)
-        print('chat_history length: ', history_length)
-        
-        token_counter_history = 0
-        if chat_history:
-            token_counter_history = chat.get_num_tokens(chat_history)
-            print('token_size of history: ', token_counter_history)
-        
         end_time_for_inference = time.time()
         time_for_inference = end_time_for_inference - start_time_for_inference
         
@@ -232,12 +711,336 @@ def general_conversation(connectionId, requestId, chat, query):
 
 
 
-def store_document_for_faiss(docs, vectorstore_faiss):
+# embeddings of chunks are computed once in batches, and the same vectors are written into faiss and opensearch
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_CONCURRENCY = int(os.environ.get('embeddingConcurrency', '4'))  # concurrent requests to Bedrock
+faiss_lock = threading.Lock()
+
+def embed_documents_once(bedrock_embedding, docs):
+    """Returns (text, embedding) pairs and metadatas of docs. Chunks which were already embedded
+    are served from the embedding cache by their content hash."""
+    start_time = time.time()
+    texts = [doc.page_content for doc in docs]
+    batches = [texts[i:i+EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix='embedding') as executor:
+        vectors = [vector for batch in executor.map(bedrock_embedding.embed_documents_as_array, batches) for vector in batch]
+    print(f'embedded {len(texts)} chunks in {len(batches)} batches: ', str(time.time() - start_time))
+
+    text_embeddings = [(text, vector.tolist()) for text, vector in zip(texts, vectors)]
+    metadatas = [doc.metadata for doc in docs]
+    return text_embeddings, metadatas
+
+def add_to_faiss(text_embeddings, metadatas, bedrock_embedding):
+    """Adds embeddings into vectorstore_faiss. It is called with faiss_lock."""
+    global vectorstore_faiss, vectorstore_faiss_delta, isReady
+    
+    if isReady == False:   
+        with init_profiler('faiss'):
+            from langchain.vectorstores.faiss import FAISS
+        vectorstore_faiss = FAISS.from_embeddings( # create vectorstore from a document
+            text_embeddings, 
+            bedrock_embedding,
+            metadatas=metadatas
+        )
+        isReady = True
+    elif faiss_mapped:  # a memory-mapped index is read-only, so the later documents are kept in a small index in memory
+        if vectorstore_faiss_delta is None:
+            from langchain.vectorstores.faiss import FAISS
+            vectorstore_faiss_delta = FAISS.from_embeddings(
+                text_embeddings, 
+                bedrock_embedding,
+                metadatas=metadatas
+            )
+        else:
+            vectorstore_faiss_delta.add_embeddings(text_embeddings, metadatas=metadatas)
+    else:
+        vectorstore_faiss.add_embeddings(text_embeddings, metadatas=metadatas)       
+
+def search_faiss(query, top_k):
+    """Returns (document, score) of the memory-mapped index and the index of later documents which are merged by score."""
+    base, delta = vectorstore_faiss, vectorstore_faiss_delta
+    if delta is None:
+        return base.similarity_search_with_score(query=query, k=top_k)
+    
+    query_vector = get_embedding(profile_of_LLMs, selected_LLM).embed_query(query)
+    relevant_documents = base.similarity_search_with_score_by_vector(query_vector, k=top_k) + delta.similarity_search_with_score_by_vector(query_vector, k=top_k)
+    return sorted(relevant_documents, key=lambda document: document[1])[:top_k]  # L2 distance
+
+def store_document_for_faiss(text_embeddings, metadatas, bedrock_embedding):
     print('store document into faiss')    
-    vectorstore_faiss.add_documents(docs)       
+    with faiss_lock:
+        if enableFaissSnapshot == 'true':
+            try:
+                generation = publish_faiss_delta(text_embeddings, metadatas, bedrock_embedding)
+            except Exception:
+                err_msg = traceback.format_exc()
+                print('error message: ', err_msg)
+                generation = None
+            
+            add_to_faiss(text_embeddings, metadatas, bedrock_embedding)
+            if generation is not None:
+                update_faiss_snapshot(generation)
+        else:
+            add_to_faiss(text_embeddings, metadatas, bedrock_embedding)
     print('uploaded into faiss')
 
-def store_document_for_opensearch(bedrock_embedding, docs, userId, documentId):
+# faiss index is shared by containers through snapshots which are versioned by generation. Every ingestion is published
+# as the delta of a new generation, and a full snapshot is written every FAISS_FULL_SNAPSHOT_INTERVAL generations.
+# A new container restores the latest full snapshot from /tmp by memory-mapping, and the later deltas are added into
+# a small index in memory which is searched together with the mapped one.
+enableFaissSnapshot = os.environ.get('enableFaissSnapshot', 'true' if 'faiss' in capabilities else 'false')
+faissSnapshotPath = os.environ.get('faissSnapshotPath', '')  # a local directory which stands in for S3
+FAISS_SNAPSHOT_PREFIX = 'faiss'
+FAISS_FULL_SNAPSHOT_INTERVAL = int(os.environ.get('faissFullSnapshotInterval', '10'))  # generations
+FAISS_SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('faissSnapshotCheckInterval', '60'))  # seconds
+FAISS_MAX_PUBLISH_ATTEMPTS = 5
+FAISS_LOCAL_PATH = '/tmp/faiss'
+FAISS_COPY_BATCH_SIZE = 10000  # vectors which are copied at once when the mapped index is merged
+faiss_generation = 0      # generation of vectorstore_faiss in this container
+faiss_full_generation = 0 # generation of the latest full snapshot which is known
+faiss_checked_at = 0.0
+faiss_mapped = False      # the index is memory-mapped from the file of the snapshot
+vectorstore_faiss_delta = None  # documents which were added after the index was memory-mapped
+
+def put_snapshot_object(key, body, exclusive=False):
+    """Writes the object. If exclusive, returns False when the object exists."""
+    if faissSnapshotPath:
+        filename = os.path.join(faissSnapshotPath, key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if exclusive:
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+        else:
+            with open(filename+'.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(filename+'.tmp', filename)
+        return True
+    
+    if exclusive:
+        try:
+            s3.put_object(Bucket=s3_bucket, Key=key, Body=body, IfNoneMatch='*')
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+    
+    s3.put_object(Bucket=s3_bucket, Key=key, Body=body)
+    return True
+
+def get_snapshot_object(key):
+    """Returns the body of the object, or None if it doesn't exist."""
+    if faissSnapshotPath:
+        filename = os.path.join(faissSnapshotPath, key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return f.read()
+    
+    try:
+        return s3.get_object(Bucket=s3_bucket, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+
+def download_snapshot_object(key, filename):
+    if faissSnapshotPath:
+        shutil.copyfile(os.path.join(faissSnapshotPath, key), filename)
+    else:
+        s3.download_file(s3_bucket, key, filename)
+
+def get_faiss_generation_key(generation):
+    return f'{FAISS_SNAPSHOT_PREFIX}/generations/{generation:010d}.json'
+
+def publish_faiss_delta(text_embeddings, metadatas, bedrock_embedding):
+    """Uploads the embeddings as a delta and claims the next generation for it. 
+    Deltas of other containers are applied first, so every container adds documents in the same order."""
+    sync_faiss_snapshot(bedrock_embedding)
+
+    delta_key = f'{FAISS_SNAPSHOT_PREFIX}/deltas/{uuid.uuid4().hex}'
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray([vector for _, vector in text_embeddings], dtype=np.float32), allow_pickle=False)
+    put_snapshot_object(delta_key+'.npy', buffer.getvalue())
+    put_snapshot_object(delta_key+'.json', json.dumps({
+        'texts': [text for text, _ in text_embeddings],
+        'metadatas': metadatas
+    }).encode('utf-8'))
+
+    for attempt in range(FAISS_MAX_PUBLISH_ATTEMPTS):
+        generation = faiss_generation + 1
+        record = {
+            'generation': generation,
+            'delta': delta_key
+        }
+        if put_snapshot_object(get_faiss_generation_key(generation), json.dumps(record).encode('utf-8'), exclusive=True):
+            print('published faiss generation: ', generation)
+            return generation
+        
+        print(f'faiss generation {generation} was published by another container')
+        sync_faiss_snapshot(bedrock_embedding)
+    raise Exception ("Not able to publish the faiss snapshot")
+
+def update_faiss_snapshot(generation):
+    """Moves this container to the generation which was published, and writes a full snapshot if it is the time."""
+    global faiss_generation, faiss_full_generation
+    faiss_generation = generation
+
+    if generation % FAISS_FULL_SNAPSHOT_INTERVAL == 0:
+        try:
+            start_time = time.time()
+            write_faiss_full_snapshot(generation)
+            faiss_full_generation = generation
+            print('full snapshot of faiss: ', str(time.time() - start_time))
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+
+    try:
+        put_snapshot_object(f'{FAISS_SNAPSHOT_PREFIX}/latest.json', json.dumps({
+            'generation': generation,
+            'full': faiss_full_generation
+        }).encode('utf-8'))
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+
+def write_faiss_full_snapshot(generation):
+    """Writes the index with the later documents as a full snapshot. Then this container maps the file of it as well,
+    so the merged index is in memory only while it is written."""
+    import faiss
+    stores = [store for store in (vectorstore_faiss, vectorstore_faiss_delta) if store is not None]
+    index = vectorstore_faiss.index
+    if vectorstore_faiss_delta is not None:  # a clone of the mapped index is still a view, so the vectors are copied into a flat index
+        index = faiss.IndexFlat(index.d, index.metric_type)
+        for store in stores:
+            for start in range(0, store.index.ntotal, FAISS_COPY_BATCH_SIZE):
+                index.add(store.index.reconstruct_n(start, min(FAISS_COPY_BATCH_SIZE, store.index.ntotal - start)))
+
+    os.makedirs(FAISS_LOCAL_PATH, exist_ok=True)
+    filename = os.path.join(FAISS_LOCAL_PATH, f'{generation}.write.faiss')
+    faiss.write_index(index, filename)
+    del index
+
+    records = []
+    for store in stores:
+        for i in range(store.index.ntotal):
+            docstore_id = store.index_to_docstore_id[i]
+            doc = store.docstore.search(docstore_id)
+            records.append({
+                'id': docstore_id,
+                'text': doc.page_content,
+                'metadata': doc.metadata
+            })
+    
+    # the docstore is written after the index, so a full snapshot is complete when its docstore exists
+    key = f'{FAISS_SNAPSHOT_PREFIX}/full/{generation:010d}'
+    try:
+        with open(filename, 'rb') as f:
+            put_snapshot_object(key+'/index.faiss', f.read())
+        put_snapshot_object(key+'/docstore.json', json.dumps(records).encode('utf-8'))
+    except Exception:
+        os.remove(filename)
+        raise
+    
+    mapped_filename = os.path.join(FAISS_LOCAL_PATH, f'{generation}.faiss')
+    os.replace(filename, mapped_filename)
+    map_faiss_index(mapped_filename, generation, records, vectorstore_faiss.embedding_function)
+
+def map_faiss_index(filename, generation, records, bedrock_embedding):
+    """Replaces vectorstore_faiss with the index which is memory-mapped from the file."""
+    global vectorstore_faiss, vectorstore_faiss_delta, isReady, faiss_generation, faiss_mapped
+    import faiss
+    from langchain.vectorstores.faiss import FAISS
+    from langchain.docstore.in_memory import InMemoryDocstore
+
+    # IO_FLAG_MMAP maps only inverted lists. The codes of IndexFlatL2 which langchain builds are mapped by IO_FLAG_MMAP_IFC
+    index = faiss.read_index(filename, getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP))
+    
+    docstore = InMemoryDocstore({record['id']: Document(page_content=record['text'], metadata=record['metadata']) for record in records})
+    index_to_docstore_id = {i: record['id'] for i, record in enumerate(records)}
+    vectorstore_faiss = FAISS(bedrock_embedding, index, docstore, index_to_docstore_id)
+    vectorstore_faiss_delta = None
+    isReady = True
+    faiss_generation = generation
+    faiss_mapped = True
+    
+    for name in os.listdir(FAISS_LOCAL_PATH):  # files of older snapshots are not mapped anymore
+        if name.endswith('.faiss') and name != os.path.basename(filename):
+            os.remove(os.path.join(FAISS_LOCAL_PATH, name))
+
+def restore_faiss_full_snapshot(generation, bedrock_embedding):
+    start_time = time.time()
+    key = f'{FAISS_SNAPSHOT_PREFIX}/full/{generation:010d}'
+    body = get_snapshot_object(key+'/docstore.json')
+    if body is None:
+        return False
+    records = json.loads(body)
+    
+    os.makedirs(FAISS_LOCAL_PATH, exist_ok=True)
+    filename = os.path.join(FAISS_LOCAL_PATH, f'{generation}.faiss')
+    download_snapshot_object(key+'/index.faiss', filename)
+    map_faiss_index(filename, generation, records, bedrock_embedding)
+    print(f'restored faiss snapshot {generation} ({len(records)} documents): ', str(time.time() - start_time))
+    return True
+
+def apply_faiss_delta(record, bedrock_embedding):
+    global faiss_generation
+    vectors = np.load(io.BytesIO(get_snapshot_object(record['delta']+'.npy')), allow_pickle=False)
+    delta = json.loads(get_snapshot_object(record['delta']+'.json'))
+    
+    add_to_faiss(list(zip(delta['texts'], vectors.tolist())), delta['metadatas'], bedrock_embedding)
+    faiss_generation = record['generation']
+
+def sync_faiss_snapshot(bedrock_embedding):
+    """Brings vectorstore_faiss up to the latest generation. It is called with faiss_lock."""
+    global faiss_checked_at, faiss_full_generation
+    faiss_checked_at = time.time()
+    generation = faiss_generation
+
+    body = get_snapshot_object(f'{FAISS_SNAPSHOT_PREFIX}/latest.json')
+    if body is not None:
+        latest = json.loads(body)
+        faiss_full_generation = max(faiss_full_generation, latest['full'])
+        # a full snapshot is restored if this container is empty or too far behind. A mapped container restores every newer one,
+        # since it is mapped without reading the index, and the index of later documents is kept small
+        if faiss_full_generation > generation and (not isReady or faiss_mapped or faiss_full_generation - generation > FAISS_FULL_SNAPSHOT_INTERVAL):
+            restore_faiss_full_snapshot(faiss_full_generation, bedrock_embedding)
+    
+    # the pointer may be behind, so the following generations are probed
+    while True:
+        body = get_snapshot_object(get_faiss_generation_key(faiss_generation + 1))
+        if body is None:
+            break
+        apply_faiss_delta(json.loads(body), bedrock_embedding)
+    
+    if faiss_generation != generation:
+        print(f'faiss was synchronized from generation {generation} to {faiss_generation}')
+
+def check_faiss_snapshot():
+    if enableFaissSnapshot != 'true' or time.time() - faiss_checked_at < FAISS_SNAPSHOT_CHECK_INTERVAL:
+        return
+    
+    bedrock_embedding = get_embedding(profile_of_LLMs, selected_LLM)
+    with faiss_lock:
+        if time.time() - faiss_checked_at < FAISS_SNAPSHOT_CHECK_INTERVAL:  # checked by another thread
+            return
+        try:
+            sync_faiss_snapshot(bedrock_embedding)
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+
+def load_opensearch():
+    with init_profiler('opensearch'):
+        from langchain.vectorstores.opensearch_vector_search import OpenSearchVectorSearch
+    return OpenSearchVectorSearch
+
+def store_document_for_opensearch(bedrock_embedding, text_embeddings, metadatas, userId, documentId):
+    OpenSearchVectorSearch = load_opensearch()
     new_vectorstore = OpenSearchVectorSearch(
         index_name="rag-index-"+userId,
         is_aoss = False,
@@ -246,11 +1049,55 @@ def store_document_for_opensearch(bedrock_embedding, docs, userId, documentId):
         opensearch_url = opensearch_url,
         http_auth=(opensearch_account, opensearch_passwd),
     )
-    response = new_vectorstore.add_documents(docs)    
+    response = new_vectorstore.add_embeddings(text_embeddings, metadatas=metadatas)    
     print('response of adding documents: ', response)
     
     print('uploaded into opensearch')
 
+# the vectorstore for search is shared in a warm container per embedding of the region
+map_opensearch_vectorstore = dict()   # embedding -> OpenSearchVectorSearch
+
+def get_opensearch_vectorstore(bedrock_embedding):
+    vectorstore = map_opensearch_vectorstore.get(bedrock_embedding)
+    if vectorstore is None:
+        OpenSearchVectorSearch = load_opensearch()
+        vectorstore = OpenSearchVectorSearch(
+            index_name = "rag-index-*", # all
+            #index_name = 'rag-index-'+userId+'-*',
+            is_aoss = False,
+            ef_search = 1024, # 512(default)
+            m=48,
+            #engine="faiss",  # default: nmslib
+            embedding_function = bedrock_embedding,
+            opensearch_url=opensearch_url,
+            http_auth=(opensearch_account, opensearch_passwd), # http_auth=awsauth,
+        )
+        map_opensearch_vectorstore[bedrock_embedding] = vectorstore
+    return vectorstore
+
+# kendra client is shared in a warm container
+KENDRA_MAX_POOL_CONNECTIONS = 20
+kendra_lock = threading.Lock()
+kendra_client = None
+kendra_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='kendra')
+
+def get_kendra_client():
+    global kendra_client
+    if kendra_client is None:
+        with kendra_lock:
+            if kendra_client is None:
+                kendra_client = boto3.client(
+                    service_name='kendra', 
+                    region_name=kendra_region,
+                    config = Config(
+                        retries=dict(
+                            max_attempts=10
+                        ),
+                        max_pool_connections = KENDRA_MAX_POOL_CONNECTIONS
+                    )
+                )
+    return kendra_client
+
 # store document into Kendra
 def store_document_for_kendra(path, s3_file_name, documentId):
     print('store document to kendra')
@@ -272,15 +1119,7 @@ def store_document_for_kendra(path, s3_file_name, documentId):
     else:
         file_type = ext
 
-    kendra_client = boto3.client(
-        service_name='kendra', 
-        region_name=kendra_region,
-        config = Config(
-            retries=dict(
-                max_attempts=10
-            )
-        )
-    )
+    kendra_client = get_kendra_client()
 
     documents = [
         {
@@ -317,106 +1156,235 @@ def store_document_for_kendra(path, s3_file_name, documentId):
     # print('batch_put_document(kendra): ', result)
     print('uploaded into kendra')
 
-# load documents from s3 for pdf and txt
-def load_document(file_type, s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
+# documents are spooled into /tmp, and pages of pdf are extracted in parallel by worker processes
+DOCUMENT_SPOOL_PATH = '/tmp/docs'
+EXTRACTION_WORKERS = min(4, os.cpu_count() or 1)
+MIN_PAGES_FOR_PARALLEL_EXTRACTION = 8
+TEXT_BUFFER_SIZE = 10000  # characters of txt which are split at once
+
+def get_text_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=100,
+        separators=["\n\n", "\n", ".", " ", ""],
+        length_function = len,
+    ) 
+
+def download_document(s3_file_name):
+    os.makedirs(DOCUMENT_SPOOL_PATH, exist_ok=True)
+    ext = s3_file_name[s3_file_name.rfind('.'):]
+    filename = os.path.join(DOCUMENT_SPOOL_PATH, hashlib.sha256(s3_file_name.encode('utf-8')).hexdigest()+ext)
     
+    start_time = time.time()
+    s3.download_file(s3_bucket, s3_prefix+'/'+s3_file_name, filename)  # ranged and streamed into the file
+    print(f'downloaded {s3_file_name} ({os.path.getsize(filename)} bytes): ', str(time.time() - start_time))
+    return filename
+
+def extract_pdf_pages(conn, filename, pages, output_dir):
+    import PyPDF2
+    try:
+        reader = PyPDF2.PdfReader(filename)
+        for i in pages:
+            text = reader.pages[i].extract_text()
+            with open(os.path.join(output_dir, f'{i}.txt'), 'w', encoding='utf-8') as f:
+                f.write(text or '')
+            conn.send(i)
+    finally:
+        conn.send(None)
+        conn.close()
+
+def read_pdf_pages(filename):
+    """Yields (page number, text) in order of pages. Pages are extracted in parallel by worker processes
+    which write the text of every page into a file, so that only a page is kept in memory at once."""
+    with init_profiler('PyPDF2'):
+        import PyPDF2
+    reader = PyPDF2.PdfReader(filename)
+    number_of_pages = len(reader.pages)
+    print('number of pages: ', number_of_pages)
+
+    workers = min(EXTRACTION_WORKERS, number_of_pages)
+    if workers <= 1 or number_of_pages < MIN_PAGES_FOR_PARALLEL_EXTRACTION:
+        for i, page in enumerate(reader.pages):
+            yield i+1, page.extract_text()
+        return
+
+    from multiprocessing import Process, Pipe
+    from multiprocessing.connection import wait as wait_for_connections
+    output_dir = filename+'.pages'
+    os.makedirs(output_dir, exist_ok=True)
+    processes = []
+    connections = []
+    for w in range(workers):
+        parent_conn, child_conn = Pipe()
+        pages = list(range(w, number_of_pages, workers))  # interleaved, so pages are completed nearly in order
+        process = Process(target=extract_pdf_pages, args=(child_conn, filename, pages, output_dir))
+        process.start()
+        child_conn.close()
+        processes.append(process)
+        connections.append(parent_conn)
+
+    try:
+        completed = set()
+        for i in range(number_of_pages):
+            while i not in completed:
+                if not connections:
+                    raise Exception (f"Not able to extract page {i+1}")
+                for conn in wait_for_connections(connections):
+                    try:
+                        page = conn.recv()
+                    except EOFError:
+                        page = None
+                    if page is None:
+                        connections.remove(conn)
+                    else:
+                        completed.add(page)
+            
+            page_file = os.path.join(output_dir, f'{i}.txt')
+            with open(page_file, 'r', encoding='utf-8') as f:
+                text = f.read()
+            os.remove(page_file)
+            yield i+1, text
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def read_document_pages(file_type, filename):
+    """Yields (page number, text). Page number is empty if the document doesn't have pages."""
     if file_type == 'pdf':
-        Byte_contents = doc.get()['Body'].read()
-        reader = PyPDF2.PdfReader(BytesIO(Byte_contents))
-        
-        texts = []
-        for page in reader.pages:
-            texts.append(page.extract_text())
-        contents = '\n'.join(texts)
+        yield from read_pdf_pages(filename)
         
     elif file_type == 'pptx':
-        Byte_contents = doc.get()['Body'].read()
-            
         from pptx import Presentation
-        prs = Presentation(BytesIO(Byte_contents))
+        prs = Presentation(filename)
 
-        texts = []
         for i, slide in enumerate(prs.slides):
             text = ""
             for shape in slide.shapes:
                 if shape.has_text_frame:
                     text = text + shape.text
-            texts.append(text)
-        contents = '\n'.join(texts)
+            yield i+1, text
         
     elif file_type == 'txt':        
-        contents = doc.get()['Body'].read().decode('utf-8')
+        with open(filename, 'r', encoding='utf-8') as f:
+            texts = []
+            size = 0
+            for line in f:
+                texts.append(line)
+                size += len(line)
+                if size >= TEXT_BUFFER_SIZE:
+                    yield "", ''.join(texts)
+                    texts = []
+                    size = 0
+            if texts:
+                yield "", ''.join(texts)
 
     elif file_type == 'docx':
-        Byte_contents = doc.get()['Body'].read()
-            
         import docx
-        doc_contents =docx.Document(BytesIO(Byte_contents))
+        doc_contents =docx.Document(filename)
 
         texts = []
+        size = 0
         for i, para in enumerate(doc_contents.paragraphs):
             if(para.text):
                 texts.append(para.text)
+                size += len(para.text)
                 # print(f"{i}: {para.text}")        
-        contents = '\n'.join(texts)
-            
-    # print('contents: ', contents)
-    new_contents = str(contents).replace("\n"," ") 
-    print('length: ', len(new_contents))
+                if size >= TEXT_BUFFER_SIZE:
+                    yield "", '\n'.join(texts)
+                    texts = []
+                    size = 0
+        if texts:
+            yield "", '\n'.join(texts)
+
+# load documents from s3 for pdf, txt, pptx and docx
+def load_document(file_type, s3_file_name):
+    """Yields chunks of the document as Documents with the page number in their metadata."""
+    filename = download_document(s3_file_name)
+    text_splitter = get_text_splitter()
+    uri = path+parse.quote(s3_file_name)
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100,
-        separators=["\n\n", "\n", ".", " ", ""],
-        length_function = len,
-    ) 
+    try:
+        length = 0
+        for page, contents in read_document_pages(file_type, filename):
+            new_contents = str(contents).replace("\n"," ") 
+            length += len(new_contents)
+
+            for text in text_splitter.split_text(new_contents):
+                metadata = {
+                    'name': s3_file_name,
+                    'uri': uri
+                }
+                if page:
+                    metadata['page'] = page
+                yield Document(
+                    page_content=text,
+                    metadata=metadata
+                )
+        print('length: ', length)
+    finally:
+        os.remove(filename)
 
-    texts = text_splitter.split_text(new_contents) 
-                
-    return texts
+# rows of csv are grouped into chunks. The columns in csvColumnsToMetadata are projected into the metadata.
+CSV_CHUNK_SIZE = int(os.environ.get('csvChunkSize', '1000'))  # characters
+columns_to_metadata = json.loads(os.environ.get('csvColumnsToMetadata', '[]'))  # e.g. ["type","Source"]
 
 # load csv documents from s3
 def load_csv_document(s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
-
-    lines = doc.get()['Body'].read().decode('utf-8').split('\n')   # read csv per line
-    print('lins: ', len(lines))
-        
-    columns = lines[0].split(',')  # get columns
-    #columns = ["Category", "Information"]  
-    #columns_to_metadata = ["type","Source"]
-    print('columns: ', columns)
-    
-    docs = []
-    n = 0
-    for row in csv.DictReader(lines, delimiter=',',quotechar='"'):
-        # print('row: ', row)
-        #to_metadata = {col: row[col] for col in columns_to_metadata if col in row}
-        values = {k: row[k] for k in columns if k in row}
-        content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in values.items())
-        doc = Document(
-            page_content=content,
-            metadata={
-                'name': s3_file_name,
-                'page': n+1,
-                'uri': path+parse.quote(s3_file_name)
-            }
-            #metadata=to_metadata
+    """Yields Documents of rows which are read lazily from the stream of S3 object. 
+    Rows are grouped up to CSV_CHUNK_SIZE and the range of rows is kept in the metadata."""
+    doc = s3.get_object(Bucket=s3_bucket, Key=s3_prefix+'/'+s3_file_name)
+    body = doc['Body']
+    uri = path+parse.quote(s3_file_name)
+
+    def to_document(contents, start_row, end_row, to_metadata):
+        metadata={
+            'name': s3_file_name,
+            'page': start_row,
+            'rows': f"{start_row}-{end_row}",
+            'uri': uri
+        }
+        metadata.update(to_metadata)
+        return Document(
+            page_content="\n\n".join(contents),
+            metadata=metadata
         )
-        docs.append(doc)
-        n = n+1
-    print('docs[0]: ', docs[0])
 
-    return docs
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(body, encoding='utf-8-sig', newline=''), delimiter=',',quotechar='"')
+        print('columns: ', reader.fieldnames)
+        
+        contents = []
+        size = 0
+        start_row = 1
+        current_metadata = None
+        n = 0
+        for n, row in enumerate(reader, start=1):
+            # print('row: ', row)
+            to_metadata = {col: (row[col] or "").strip() for col in columns_to_metadata if col in row}
+            content = "\n".join(f"{k.strip()}: {(v or '').strip()}" for k, v in row.items() if k is not None and k not in to_metadata)
+            
+            # a chunk has the rows which have the same metadata
+            if contents and (size + len(content) > CSV_CHUNK_SIZE or to_metadata != current_metadata):
+                yield to_document(contents, start_row, n-1, current_metadata)
+                contents = []
+                size = 0
+                start_row = n
+            
+            contents.append(content)
+            size += len(content)
+            current_metadata = to_metadata
+        
+        if contents:
+            yield to_document(contents, start_row, n, current_metadata)
+        print('rows: ', n)
+    finally:
+        body.close()
 
-def get_summary(chat, docs):    
-    text = ""
-    for doc in docs:
-        text = text + doc
-    
+def summarize_text(text, preferred=None):    
     if isKorean(text)==True:
         system = (
             "다음의 <article> tag안의 문장을 요약해서 500자 이내로 설명하세오."
@@ -441,15 +1409,16 @@ def get_summary(chat, docs):
     prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
     print('prompt: ', prompt)
     
-    chain = prompt | chat    
     try: 
-        result = chain.invoke(
+        chat, stream = stream_from_LLM(
+            prompt, 
             {
                 "text": text
-            }
+            },
+            preferred=preferred
         )
         
-        summary = result.content
+        summary = ''.join(chunk.content for chunk in stream)
         print('result of summarization: ', summary)
     except Exception:
         err_msg = traceback.format_exc()
@@ -458,31 +1427,458 @@ def get_summary(chat, docs):
     
     return summary
 
+# summary of a large document is made by map-reduce. Groups of chunks are summarized in parallel across regions.
+SUMMARY_MAP_TOKENS = int(os.environ.get('summaryMapTokens', '8000'))  # token budget of a map call
+SUMMARY_CONCURRENCY = int(os.environ.get('summaryConcurrency', '4'))  # concurrent map calls
+
+def estimate_tokens(text):
+    # a Hangul character is nearly a token, and other text is about 4 characters per token
+    hangul = len(re.findall('[\u3131-\u3163\uac00-\ud7a3]', text))
+    return hangul + (len(text) - hangul)//4 + 1
+
+def group_texts_by_tokens(texts, budget):
+    """Yields texts which are joined up to the budget. texts can be a stream."""
+    group = []
+    tokens = 0
+    for text in texts:
+        size = estimate_tokens(text)
+        if group and tokens + size > budget:
+            yield '\n'.join(group)
+            group = []
+            tokens = 0
+        group.append(text)
+        tokens += size
+    if group:
+        yield '\n'.join(group)
+
+def get_summary(texts):
+    """texts can be a stream of chunks. Groups of the first map are summarized as soon as they are filled,
+    so only their summaries are kept while the document is read."""
+    groups = group_texts_by_tokens(texts, SUMMARY_MAP_TOKENS)
+    first = next(groups, "")
+    second = next(groups, None)
+    if second is None:  # a short document is summarized at once
+        return summarize_text(first)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY, thread_name_prefix='summary') as executor:
+        futures = []
+        for i, text in enumerate(itertools.chain([first, second], groups)):
+            pending = [future for future in futures if not future.done()]
+            if len(pending) >= SUMMARY_CONCURRENCY:  # groups are not read ahead of the map calls
+                wait(pending, return_when=FIRST_COMPLETED)
+            futures.append(executor.submit(summarize_text, text, i % len(profile_of_LLMs)))
+        summaries = [future.result() for future in futures]
+    print(f'map-reduce summary: {len(futures)} groups, processing time for map: ', str(time.time() - start_time))
+    groups = list(group_texts_by_tokens(summaries, SUMMARY_MAP_TOKENS))
     
-def load_chat_history(userId, allowTime):
-    dynamodb_client = boto3.client('dynamodb')
-
-    response = dynamodb_client.query(
+    while len(groups) > 1:  # map
+        start_time = time.time()
+        print(f'map-reduce summary: {len(groups)} groups')
+        with ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(groups)), thread_name_prefix='summary') as executor:
+            futures = [executor.submit(summarize_text, text, i % len(profile_of_LLMs)) for i, text in enumerate(groups)]
+            summaries = [future.result() for future in futures]
+        print('processing time for map: ', str(time.time() - start_time))
+        
+        groups = list(group_texts_by_tokens(summaries, SUMMARY_MAP_TOKENS))
+
+    # reduce
+    return summarize_text(groups[0] if groups else "")
+
+# call logs are buffered during a request and written by BatchWriteItem after the answer was delivered.
+# The buffer is keyed by the primary key, so a record which is written again replaces the pending one.
+CALL_LOG_BATCH_SIZE = 25    # the limit of BatchWriteItem
+CALL_LOG_MAX_ATTEMPTS = 5
+CALL_LOG_BACKOFF = 0.05     # seconds, doubled for each retry
+call_log_lock = threading.Lock()
+call_log_buffer = OrderedDict()   # (user_id, request_time) -> item
+dynamodb_client = None
+
+def get_dynamodb_client():
+    global dynamodb_client
+    if dynamodb_client is None:
+        dynamodb_client = boto3.client('dynamodb')
+    return dynamodb_client
+
+def put_call_log(item):
+    key = (item['user_id']['S'], item['request_time']['S'])
+    with call_log_lock:
+        call_log_buffer[key] = item
+        call_log_buffer.move_to_end(key)
+
+def update_call_log(userId, requestTime, attributes):
+    """Adds attributes to the call log. The pending record is updated in the buffer without a request."""
+    with call_log_lock:
+        item = call_log_buffer.get((userId, requestTime))
+        if item is not None:
+            item.update(attributes)
+            return
+    
+    names = {f'#a{i}': name for i, name in enumerate(attributes)}
+    values = {f':v{i}': value for i, value in enumerate(attributes.values())}
+    get_dynamodb_client().update_item(
         TableName=callLogTableName,
-        KeyConditionExpression='user_id = :userId AND request_time > :allowTime',
-        ExpressionAttributeValues={
+        Key={
+            'user_id': {'S': userId},
+            'request_time': {'S': requestTime}
+        },
+        UpdateExpression='SET '+', '.join(f'#a{i} = :v{i}' for i in range(len(attributes))),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+def flush_call_log():
+    with call_log_lock:
+        items = list(call_log_buffer.values())
+        call_log_buffer.clear()
+    if not items:
+        return
+
+    start_time = time.time()
+    client = get_dynamodb_client()
+    requests = 0
+    failed = 0
+    for i in range(0, len(items), CALL_LOG_BATCH_SIZE):
+        pending = {callLogTableName: [{'PutRequest': {'Item': item}} for item in items[i:i+CALL_LOG_BATCH_SIZE]]}
+        for attempt in range(CALL_LOG_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(CALL_LOG_BACKOFF * 2**(attempt-1))
+            try:
+                response = client.batch_write_item(RequestItems=pending)
+                pending = response.get('UnprocessedItems')
+            except Exception:
+                err_msg = traceback.format_exc()
+                print('error message: ', err_msg)
+            requests += 1
+            if not pending:
+                break
+        if pending:
+            failed += len(pending.get(callLogTableName, []))
+    
+    print(f'call log: {len(items)} items, {requests} requests, failed: {failed}: ', str(time.time() - start_time))
+
+def load_chat_history(userId, allowTime, memory_chain):
+    """Rebuilds the memory from the call log and returns the rolling summary of the older dialogs.
+    The log is read from the newest with a projection, and reading stops once the summary was found."""
+    client = get_dynamodb_client()
+
+    items = []   # text dialogs from the newest
+    required = MEMORY_MAX_DIALOGS   # dialogs older than them would be folded into the summary anyway
+    summary = ""
+    pages = 0
+    query = {
+        'TableName': callLogTableName,
+        'KeyConditionExpression': 'user_id = :userId AND request_time > :allowTime',
+        'ExpressionAttributeValues': {
             ':userId': {'S': userId},
             ':allowTime': {'S': allowTime}
+        },
+        'ProjectionExpression': '#type, #body, #msg, #summary, #turns',
+        'ExpressionAttributeNames': {'#type': 'type', '#body': 'body', '#msg': 'msg', '#summary': 'summary', '#turns': 'summary_turns'},
+        'ScanIndexForward': False,
+        'Limit': MEMORY_MAX_DIALOGS
+    }
+    while len(items) < required:
+        response = client.query(**query)
+        pages += 1
+        # print('query result: ', response['Items'])
+
+        for item in response['Items']:
+            if item['type']['S'] != 'text':
+                continue
+            items.append(item)
+            if not summary and 'summary' in item:
+                # the summary covers the dialogs before the turns which were kept verbatim at that time
+                summary = item['summary']['S']
+                required = min(required, len(items) - 1 + int(item['summary_turns']['N']))
+            if len(items) >= required:
+                break
+        
+        if 'LastEvaluatedKey' not in response:
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print(f'chat history was rebuilt from the call log: {len(items[:required])} dialogs, {pages} pages')
+
+    for item in reversed(items[:required]):
+        memory_chain.chat_memory.add_user_message(item['body']['S'])
+        memory_chain.chat_memory.add_ai_message(item['msg']['S'])
+    
+    return summary
+
+# a snapshot of the memory is kept per user in the call log table, so the memory is loaded by a single read.
+# The sort key of the snapshot is out of the range of request times, so it is not read as a dialog.
+SNAPSHOT_KEY = '#snapshot'
+MEMORY_SNAPSHOT_MAX_BYTES = 300*1024  # under the limit of a DynamoDB item (400KB)
+
+def load_memory_snapshot(userId, allowTime, memory_chain):
+    """Loads the snapshot into memory_chain and returns the summary, or None if there is no valid snapshot."""
+    try:
+        response = get_dynamodb_client().get_item(
+            TableName=callLogTableName,
+            Key={
+                'user_id': {'S': userId},
+                'request_time': {'S': SNAPSHOT_KEY}
+            },
+            ProjectionExpression='#summary, #dialogs, #updated',
+            ExpressionAttributeNames={'#summary': 'summary', '#dialogs': 'dialogs', '#updated': 'updated_at'}
+        )
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return None
+    
+    item = response.get('Item')
+    if item is None or item['updated_at']['S'] <= allowTime:
+        return None
+    
+    for dialog in item['dialogs']['L']:
+        memory_chain.chat_memory.add_user_message(dialog['M']['body']['S'])
+        memory_chain.chat_memory.add_ai_message(dialog['M']['msg']['S'])
+    print(f"memory was loaded from the snapshot: {len(item['dialogs']['L'])} dialogs")
+    return item['summary']['S']
+
+def save_memory_snapshot(userId, requestTime):
+    with memory_store_lock:
+        entry = memory_store.get(userId)
+    if entry is None:
+        return
+    
+    messages = entry['memory'].chat_memory.messages
+    dialogs = []
+    size = len(entry['summary'].encode('utf-8'))
+    for i in range(len(messages)-2, -1, -2):  # from the newest within the size of an item
+        body = str(messages[i].content)
+        msg = str(messages[i+1].content)
+        size += len(body.encode('utf-8')) + len(msg.encode('utf-8'))
+        if size > MEMORY_SNAPSHOT_MAX_BYTES:
+            break
+        dialogs.append({'M': {'body': {'S': body}, 'msg': {'S': msg}}})
+    dialogs.reverse()
+
+    item = {
+        'user_id': {'S': userId},
+        'request_time': {'S': SNAPSHOT_KEY},
+        'summary': {'S': entry['summary']},
+        'dialogs': {'L': dialogs},
+        'updated_at': {'S': requestTime}
+    }
+    put_call_log(item)
+
+# conversation memory of users is kept in a LRU which is bounded by the number of users and bytes, and expired by TTL.
+# A memory which is not resident is loaded again from the call log in DynamoDB.
+MEMORY_STORE_MAX_USERS = int(os.environ.get('memoryStoreMaxUsers', '1000'))
+MEMORY_STORE_MAX_BYTES = int(os.environ.get('memoryStoreMaxBytes', '256'))*1024*1024  # bytes
+MEMORY_STORE_TTL = int(os.environ.get('memoryStoreTTL', '3600'))  # seconds since the last access
+MEMORY_MAX_DIALOGS = int(os.environ.get('memoryMaxDialogs', '50'))  # dialogs which are kept verbatim at most
+MESSAGE_OVERHEAD = 200       # approximate bytes of a message object except the content
+memory_store_lock = threading.Lock()
+memory_store = OrderedDict()   # userId -> {'memory', 'summary', 'bytes', 'last_access'}
+memory_store_counter = {
+    'users': 0,
+    'bytes': 0,
+    'hit': 0,
+    'miss': 0,
+    'evicted': 0,
+    'expired': 0
+}
+
+def get_memory_bytes(entry):
+    return len(entry['summary'].encode('utf-8')) + sum(len(str(message.content).encode('utf-8')) + MESSAGE_OVERHEAD for message in entry['memory'].chat_memory.messages)
+
+def remove_memory_entry(userId, reason):
+    entry = memory_store.pop(userId)
+    memory_store_counter['bytes'] -= entry['bytes']
+    memory_store_counter['users'] = len(memory_store)
+    memory_store_counter[reason] += 1
+
+def expire_memory_store(now):
+    # the store is ordered by the last access, so expired entries are at the front
+    while memory_store:
+        userId, entry = next(iter(memory_store.items()))
+        if now - entry['last_access'] < MEMORY_STORE_TTL:
+            break
+        remove_memory_entry(userId, 'expired')
+
+def get_memory_entry(userId):
+    now = time.time()
+    with memory_store_lock:
+        expire_memory_store(now)
+        entry = memory_store.get(userId)
+        if entry is not None:
+            memory_store.move_to_end(userId)
+            entry['last_access'] = now
+            memory_store_counter['hit'] += 1
+            print('memory exist. reuse it!')
+            return entry
+    
+    print('memory does not exist. create new one!')
+    memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=MEMORY_MAX_DIALOGS)
+    allowTime = getAllowTime()
+    summary = load_memory_snapshot(userId, allowTime, memory_chain)
+    if summary is None:  # the snapshot is written after the next dialog
+        summary = load_chat_history(userId, allowTime, memory_chain)
+
+    return put_memory_entry(userId, memory_chain, summary)
+
+def put_memory_entry(userId, memory_chain, summary):
+    with memory_store_lock:
+        entry = memory_store.get(userId)
+        if entry is not None:  # loaded by another thread in the meantime
+            memory_store.move_to_end(userId)
+            return entry
+        
+        entry = {
+            'memory': memory_chain,
+            'summary': summary,
+            'bytes': 0,
+            'last_access': time.time()
         }
-    )
-    # print('query result: ', response['Items'])
+        memory_store[userId] = entry
+        memory_store_counter['miss'] += 1
+    update_memory_store(userId)
+    return entry
+
+def update_memory_store(userId):
+    """Updates the bytes of the memory of the user and evicts the least recently used memories over the budget."""
+    with memory_store_lock:
+        entry = memory_store.get(userId)
+        if entry is not None:
+            messages = entry['memory'].chat_memory.messages
+            if len(messages) > 4*MEMORY_MAX_DIALOGS:  # only if the history was not able to be compressed
+                del messages[:len(messages)-4*MEMORY_MAX_DIALOGS]
+            
+            size = get_memory_bytes(entry)
+            memory_store_counter['bytes'] += size - entry['bytes']
+            entry['bytes'] = size
+        memory_store_counter['users'] = len(memory_store)
+
+        while len(memory_store) > 1 and (len(memory_store) > MEMORY_STORE_MAX_USERS or memory_store_counter['bytes'] > MEMORY_STORE_MAX_BYTES):
+            evicted = next(iter(memory_store))
+            if evicted == userId:  # the memory in use is kept
+                break
+            remove_memory_entry(evicted, 'evicted')
+    
+    print('memory store: ', memory_store_counter)
+
+# history in a prompt is bounded by the token budget of the model. The newest dialogs are kept verbatim,
+# and the older dialogs are folded into a rolling summary which is persisted with the call log.
+HISTORY_TOKEN_BUDGET = int(os.environ.get('historyTokenBudget', '2000'))  # default budget if the profile doesn't have 'historyTokens'
+HISTORY_FOLD_RATIO = 0.5  # the history is folded down to this ratio of the budget
+token_usage = dict()  # estimated tokens of the current request
+
+def reset_token_usage():
+    global token_usage
+    token_usage = {
+        'history': 0,
+        'prompt': 0,
+        'completion': 0
+    }
 
-    for item in response['Items']:
-        text = item['body']['S']
-        msg = item['msg']['S']
-        type = item['type']['S']
+def count_tokens(kind, *texts):
+    tokens = sum(estimate_tokens(text) for text in texts if text)
+    token_usage[kind] = token_usage.get(kind, 0) + tokens
+    return tokens
 
-        if type == 'text':
-            memory_chain.chat_memory.add_user_message(text)
-            if len(msg) > MSG_LENGTH:
-                memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                          
-            else:
-                memory_chain.chat_memory.add_ai_message(msg) 
+def get_history_budget():
+    profile = profile_of_LLMs[selected_LLM]
+    return int(profile.get('historyTokens', HISTORY_TOKEN_BUDGET))
+
+def get_history_tokens(entry):
+    messages = entry['memory'].chat_memory.messages
+    return (estimate_tokens(entry['summary']) if entry['summary'] else 0) + sum(estimate_tokens(str(message.content)) for message in messages)
+
+def split_history(entry, budget, max_dialogs=MEMORY_MAX_DIALOGS):
+    """Returns the number of the newest dialogs which are kept verbatim within the budget."""
+    messages = entry['memory'].chat_memory.messages
+    tokens = estimate_tokens(entry['summary']) if entry['summary'] else 0
+    turns = 0
+    for i in range(len(messages)-2, -1, -2):
+        if turns >= max_dialogs:
+            break
+        size = estimate_tokens(str(messages[i].content)) + estimate_tokens(str(messages[i+1].content))
+        if tokens + size > budget:
+            break
+        tokens += size
+        turns += 1
+    return turns
+
+def get_history(entry):
+    """Returns the summary of older dialogs and the messages of the newest dialogs within the token budget."""
+    messages = entry['memory'].chat_memory.messages
+    turns = split_history(entry, get_history_budget())
+    history = messages[len(messages)-2*turns:] if turns else []
+    
+    count_tokens('history', entry['summary'], *[str(message.content) for message in history])
+    print(f"history: {turns} dialogs, summary: {len(entry['summary'])} characters")
+    return entry['summary'], history
+
+def get_history_prompt(summary, system):
+    # the summary is given as a variable, since it may have braces of the template
+    if not summary:
+        return system
+    return system + "\n\n<summary>\n{summary}\n</summary>"
+
+def summarize_history(summary, messages):
+    dialogs = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    if isKorean(dialogs)==True:
+        system = (
+            "<summary> tag안의 이전 대화 요약과 <dialogs> tag안의 대화를 합쳐서 500자 이내의 새로운 요약을 작성하세요. 이후 대화에 필요한 사실과 맥락을 유지합니다."
+        )
+    else:
+        system = (
+            "Combine the summary of the earlier conversation in <summary> tags and the dialogs in <dialogs> tags into a new concise summary within 500 characters. Keep the facts and the context which are needed for the following conversation."
+        )
+    human = "<summary>{summary}</summary>\n<dialogs>{dialogs}</dialogs>"
+
+    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
+    chat, stream = stream_from_LLM(
+        prompt, 
+        {
+            "summary": summary,
+            "dialogs": dialogs
+        }
+    )
+    return ''.join(chunk.content for chunk in stream)
+
+def compress_history(userId, requestTime):
+    """Folds dialogs out of the token budget into the rolling summary. It runs after the answer was delivered."""
+    with memory_store_lock:
+        entry = memory_store.get(userId)
+    if entry is None:
+        return
+    
+    # dialogs are folded only over the budget, and down to a fraction of it, so the summary is not made for every dialog
+    messages = entry['memory'].chat_memory.messages
+    budget = get_history_budget()
+    if get_history_tokens(entry) <= budget and len(messages) <= 2*MEMORY_MAX_DIALOGS:
+        return
+    turns = split_history(entry, int(budget*HISTORY_FOLD_RATIO), int(MEMORY_MAX_DIALOGS*HISTORY_FOLD_RATIO))
+    folded = len(messages) - 2*turns
+    if folded <= 0:
+        return
+    
+    start_time = time.time()
+    try:
+        summary = summarize_history(entry['summary'], messages[:folded])
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return
+    print(f'history was compressed: {folded//2} dialogs, {len(summary)} characters: ', str(time.time() - start_time))
+    
+    entry['summary'] = summary
+    del messages[:folded]
+    update_memory_store(userId)
+
+    # the summary is kept in the log of this request with the number of the dialogs which were not folded
+    try:
+        update_call_log(userId, requestTime, {
+            'summary': {'S': summary},
+            'summary_turns': {'N': str(turns)}
+        })
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
                 
 def getAllowTime():
     d = datetime.datetime.now() - datetime.timedelta(days = 2)
@@ -500,24 +1896,56 @@ def isTyping(connectionId, requestId):
     #print('result: ', json.dumps(result))
     sendMessage(connectionId, msg_proceeding)
 
-def readStreamMsg(connectionId, requestId, stream):
-    msg = ""
+def sendDeltaMessage(connectionId, requestId, delta):
+    result = {
+        'request_id': requestId,
+        'msg': delta,
+        'status': 'delta'
+    }
+    #print('result: ', json.dumps(result))
+    sendMessage(connectionId, result)
+
+# tokens are coalesced into delta frames which are flushed by size or time window
+def readStreamMsg(connectionId, requestId, stream, start_time=None):
+    chunks = []
+    delta = []
+    delta_size = 0
+    last_flush_time = time.time()
+    if start_time is None:
+        start_time = last_flush_time
+    time_to_first_token = None
     if stream:
         for event in stream:
             #print('event: ', event)
-            msg = msg + event
-
-            result = {
-                'request_id': requestId,
-                'msg': msg,
-                'status': 'proceeding'
-            }
-            #print('result: ', json.dumps(result))
-            sendMessage(connectionId, result)
+            token = event.content if hasattr(event, 'content') else event
+            if not token:
+                continue
+            if time_to_first_token is None:
+                time_to_first_token = time.time() - start_time
+                print('time to first token: ', time_to_first_token)
+
+            chunks.append(token)
+            delta.append(token)
+            delta_size += len(token)
+
+            current_time = time.time()
+            if delta_size >= STREAM_FLUSH_SIZE or current_time - last_flush_time >= STREAM_FLUSH_INTERVAL:
+                sendDeltaMessage(connectionId, requestId, ''.join(delta))
+                delta = []
+                delta_size = 0
+                last_flush_time = current_time
+        if delta:
+            sendDeltaMessage(connectionId, requestId, ''.join(delta))
+
+    msg = ''.join(chunks)
+    print(f'streaming time: {time.time() - start_time}, size: {len(msg)}')
     # print('msg: ', msg)
+
+    if debugMessageMode == 'true' and time_to_first_token is not None:
+        sendDebugMessage(connectionId, requestId, f"time to first token: {time_to_first_token:.3f}s")
     return msg
 
-def revise_question(connectionId, requestId, chat, query):    
+def revise_question(connectionId, requestId, query):    
     global history_length, token_counter_history    
     history_length = token_counter_history = 0
         
@@ -540,21 +1968,25 @@ def revise_question(connectionId, requestId, chat, query):
         {question}
         </question>"""
             
-    prompt = ChatPromptTemplate.from_messages([("system", system), MessagesPlaceholder(variable_name="history"), ("human", human)])
-    print('prompt: ', prompt)
-    
-    history = memory_chain.load_memory_variables({})["chat_history"]
+    summary, history = get_history(memory_entry)
     print('memory_chain: ', history)
+    
+    prompt = ChatPromptTemplate.from_messages([("system", get_history_prompt(summary, system)), MessagesPlaceholder(variable_name="history"), ("human", human)])
+    print('prompt: ', prompt)
+    count_tokens('prompt', system, human, query)
                 
-    chain = prompt | chat    
     try: 
-        result = chain.invoke(
+        chat, stream = stream_from_LLM(
+            prompt, 
             {
                 "history": history,
                 "question": query,
-            }
+                "summary": summary
+            },
+            hedging=True
         )
-        generated_question = result.content
+        generated_question = ''.join(chunk.content for chunk in stream)
+        count_tokens('completion', generated_question)
         
         revised_question = generated_question[generated_question.find('<result>')+8:len(generated_question)-9] # remove <result> tag                   
         print('revised_question: ', revised_question)
@@ -566,23 +1998,11 @@ def revise_question(connectionId, requestId, chat, query):
         sendErrorMessage(connectionId, requestId, err_msg)    
         raise Exception ("Not able to request to LLM")
 
+    history_length = len(summary) + sum(len(str(dialogue_turn.content)) for dialogue_turn in history)
+    token_counter_history = token_usage['history']
+    print(f'chat_history length: {history_length}, token_size of history: {token_counter_history}')
+
     if debugMessageMode == 'true':  
-        chat_history = ""
-        for dialogue_turn in history:
-            #print('type: ', dialogue_turn.type)
-            #print('content: ', dialogue_turn.content)
-            
-            dialog = f"{dialogue_turn.type}: {dialogue_turn.content}\n"            
-            chat_history = chat_history + dialog
-                
-        history_length = len(chat_history)
-        print('chat_history length: ', history_length)
-        
-        token_counter_history = 0
-        if chat_history:
-            token_counter_history = chat.get_num_tokens(chat_history)
-            print('token_size of history: ', token_counter_history)
-            
         sendDebugMessage(connectionId, requestId, f"새로운 질문: {revised_question}\n * 대화이력({str(history_length)}자, {token_counter_history} Tokens)을 활용하였습니다.")
             
     return revised_question    
@@ -601,7 +2021,7 @@ def isKorean(text):
         print('Not Korean: ', word_kor)
         return False
     
-def query_using_RAG_context(connectionId, requestId, chat, context, revised_question):    
+def query_using_RAG_context(connectionId, requestId, context, revised_question):    
     if isKorean(revised_question)==True:
         system = (
             """다음의 <context> tag안의 참고자료를 이용하여 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant의 이름은 서연이고, 모르는 질문을 받으면 솔직히 모른다고 말합니다.
@@ -623,19 +2043,22 @@ def query_using_RAG_context(connectionId, requestId, chat, context, revised_ques
     
     prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
     print('prompt: ', prompt)
+    count_tokens('prompt', system, context, revised_question)
                    
-    chain = prompt | chat
-    
     try: 
         isTyping(connectionId, requestId)  
-        stream = chain.invoke(
+        start_time = time.time()
+        chat, stream = stream_from_LLM(
+            prompt, 
             {
                 "context": context,
                 "input": revised_question,
-            }
+            },
+            hedging=True
         )
-        msg = readStreamMsg(connectionId, requestId, stream.content)    
+        msg = readStreamMsg(connectionId, requestId, stream, start_time)    
         print('msg: ', msg)
+        count_tokens('completion', msg)
         
     except Exception:
         err_msg = traceback.format_exc()
@@ -646,20 +2069,31 @@ def query_using_RAG_context(connectionId, requestId, chat, context, revised_ques
 
     return msg
 
-from langchain.retrievers import AmazonKendraRetriever
-kendraRetriever = AmazonKendraRetriever(
-    index_id=kendraIndex, 
-    top_k=top_k, 
-    region_name=kendra_region,
-    attribute_filter = {
-        "EqualsTo": {      
-            "Key": "_language_code",
-            "Value": {
-                "StringValue": "ko"
-            }
-        },
-    },
-)
+kendraRetriever = None
+
+def get_kendra_retriever():
+    global kendraRetriever
+    if kendraRetriever is None:
+        kendra_client = get_kendra_client()
+        with kendra_lock:
+            if kendraRetriever is None:
+                with init_profiler('kendra retriever'):
+                    from langchain.retrievers import AmazonKendraRetriever
+                    kendraRetriever = AmazonKendraRetriever(
+                        index_id=kendraIndex, 
+                        top_k=top_k, 
+                        region_name=kendra_region,
+                        client=kendra_client,
+                        attribute_filter = {
+                            "EqualsTo": {      
+                                "Key": "_language_code",
+                                "Value": {
+                                    "StringValue": "ko"
+                                }
+                            },
+                        },
+                    )
+    return kendraRetriever
 
 def retrieve_from_kendra(query, top_k):
     if kendra_method == 'kendra_retriever':
@@ -673,7 +2107,7 @@ def retrieve_from_kendra_using_kendra_retriever(query, top_k):
     print('query: ', query)
 
     relevant_docs = []
-    relevant_documents = kendraRetriever.get_relevant_documents(
+    relevant_documents = get_kendra_retriever().get_relevant_documents(
         query=query,
         top_k=top_k,
     )
@@ -745,22 +2179,26 @@ def retrieve_from_kendra_using_kendra_retriever(query, top_k):
 def retrieve_from_kendra_using_custom_retriever(query, top_k):
     print('query: ', query)
 
-    relevant_documents = kendraRetriever.get_relevant_documents(
-        query=query,
-        top_k=top_k,
-    )
-    print('length of relevant_documents: ', len(relevant_documents))
-    print('relevant_documents: ', relevant_documents)    
-
     index_id = kendraIndex        
-    kendra_client = boto3.client(
-        service_name='kendra', 
-        region_name=kendra_region,
-        config = Config(
-            retries=dict(
-                max_attempts=10
-            )
-        )
+    kendra_client = get_kendra_client()
+    attribute_filter = {
+        "EqualsTo": {      
+            "Key": "_language_code",
+            "Value": {
+                "StringValue": "ko"
+            }
+        },
+    }
+
+    # Retrieve and FAQ Query are requested at the same time
+    print('Looking for FAQ...')
+    faq_future = kendra_executor.submit(
+        kendra_client.query,
+        IndexId = index_id,
+        QueryText = query,
+        PageSize = 4, # Maximum number of results returned for FAQ = 4 (default)
+        QueryResultTypeFilter = "QUESTION_ANSWER",  # 'QUESTION_ANSWER', 'ANSWER', "DOCUMENT"
+        AttributeFilter = attribute_filter,      
     )
 
     try:
@@ -768,14 +2206,7 @@ def retrieve_from_kendra_using_custom_retriever(query, top_k):
             IndexId = index_id,
             QueryText = query,
             PageSize = top_k,      
-            AttributeFilter = {
-                "EqualsTo": {      
-                    "Key": "_language_code",
-                    "Value": {
-                        "StringValue": "ko"
-                    }
-                },
-            },      
+            AttributeFilter = attribute_filter,      
         )
         # print('retrieve resp:', json.dumps(resp))
         query_id = resp["QueryId"]
@@ -787,22 +2218,8 @@ def retrieve_from_kendra_using_custom_retriever(query, top_k):
                 retrieve_docs.append(extract_relevant_doc_for_kendra(query_id=query_id, apiType="retrieve", query_result=query_result))
                 # print('retrieve_docs: ', retrieve_docs)
 
-            print('Looking for FAQ...')
             try:
-                resp =  kendra_client.query(
-                    IndexId = index_id,
-                    QueryText = query,
-                    PageSize = 4, # Maximum number of results returned for FAQ = 4 (default)
-                    QueryResultTypeFilter = "QUESTION_ANSWER",  # 'QUESTION_ANSWER', 'ANSWER', "DOCUMENT"
-                    AttributeFilter = {
-                        "EqualsTo": {      
-                            "Key": "_language_code",
-                            "Value": {
-                                "StringValue": "ko"
-                            }
-                        },
-                    },      
-                )
+                resp = faq_future.result()
                 print('query resp:', json.dumps(resp))
                 query_id = resp["QueryId"]
 
@@ -841,14 +2258,7 @@ def retrieve_from_kendra_using_custom_retriever(query, top_k):
                     QueryText = query,
                     PageSize = top_k,
                     #QueryResultTypeFilter = "DOCUMENT",  # 'QUESTION_ANSWER', 'ANSWER', "DOCUMENT"
-                    AttributeFilter = {
-                        "EqualsTo": {      
-                            "Key": "_language_code",
-                            "Value": {
-                                "StringValue": "ko"
-                            }
-                        },
-                    },      
+                    AttributeFilter = attribute_filter,      
                 )
                 print('query resp:', resp)
                 query_id = resp["QueryId"]
@@ -978,44 +2388,49 @@ def extract_relevant_doc_for_kendra(query_id, apiType, query_result):
             }
     return doc_info
 
-def priority_search(query, relevant_docs, bedrock_embedding):
-    excerpts = []
-    for i, doc in enumerate(relevant_docs):
-        # print('doc: ', doc)
-        excerpts.append(
-            Document(
-                page_content=doc['metadata']['excerpt'],
-                metadata={
-                    'name': doc['metadata']['title'],
-                    'order':i,
-                }
-            )
-        )  
-    # print('excerpts: ', excerpts)
-
-    embeddings = bedrock_embedding
-    vectorstore_confidence = FAISS.from_documents(
-        excerpts,  # documents
-        embeddings  # embeddings
-    )            
-    rel_documents = vectorstore_confidence.similarity_search_with_score(
-        query=query,
-        k=top_k
-    )
+# reranker: candidates are scored by normalized vectors, cosine similarity (higher is better) or L2 distance (0~2, lower is better)
+RERANK_METRIC = os.environ.get('rerankMetric', 'cosine')  # cosine or l2
+RERANK_THRESHOLD = float(os.environ.get('rerankThreshold', '0.4' if RERANK_METRIC == 'cosine' else '1.1'))
 
-    docs = []
-    for i, document in enumerate(rel_documents):
-        print(f'## Document {i+1}: {document}')
+def rerank(query_vector, doc_vectors, metric=RERANK_METRIC, threshold=RERANK_THRESHOLD, k=top_k):
+    """Scores every candidate against the query in one matrix operation. 
+    Returns the scores of all candidates and the (index, score) of the selected ones in order of relevance."""
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    doc_vectors = np.asarray(doc_vectors, dtype=np.float32)
+
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    doc_vectors = doc_vectors / np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+    similarity = doc_vectors @ query_vector
+
+    if metric == 'l2':
+        scores = np.sqrt(np.maximum(2.0 - 2.0*similarity, 0.0))
+        order = np.argsort(scores, kind='stable')
+        passed = scores <= threshold
+    else:
+        scores = similarity
+        order = np.argsort(-scores, kind='stable')
+        passed = scores >= threshold
+    
+    selected = [(int(i), float(scores[i])) for i in order[:k] if passed[i]]
+    return scores, selected
 
-        order = document[0].metadata['order']
-        name = document[0].metadata['name']
-        assessed_score = document[1]
-        print(f"{order} {name}: {assessed_score}")
+def priority_search(query, relevant_docs, bedrock_embedding):
+    start_time = time.time()
+    excerpts = [doc['metadata']['excerpt'] for doc in relevant_docs]
+    
+    query_vector = bedrock_embedding.embed_query_as_array(query)
+    doc_vectors = bedrock_embedding.embed_documents_as_array(excerpts)
+    print('processing time for embedding: ', str(time.time() - start_time))
 
-        relevant_docs[order]['assessed_score'] = int(assessed_score)
+    start_time = time.time()
+    scores, selected = rerank(query_vector, doc_vectors)
+    print(f'processing time for rerank ({RERANK_METRIC}): ', str(time.time() - start_time))
 
-        if assessed_score < 200:
-            docs.append(relevant_docs[order])    
+    for i, doc in enumerate(relevant_docs):
+        doc['assessed_score'] = round(float(scores[i]), 3)
+        print(f"{i} {doc['metadata']['title']}: {doc['assessed_score']}")
+
+    docs = [relevant_docs[i] for i, score in selected]
     # print('selected docs: ', docs)
 
     return docs
@@ -1096,11 +2511,10 @@ def retrieve_from_vectorstore(query, top_k, rag_type):
     print('query: ', query)
 
     relevant_docs = []
+    if rag_type == 'faiss':
+        check_faiss_snapshot()  # documents of other containers are followed
     if rag_type == 'faiss' and isReady:
-        relevant_documents = vectorstore_faiss.similarity_search_with_score(
-            query = query,
-            k = top_k,
-        )
+        relevant_documents = search_faiss(query, top_k)
         
         for i, document in enumerate(relevant_documents):
             print(f'## Document {i+1}: {document}')
@@ -1195,73 +2609,317 @@ def retrieve_from_vectorstore(query, top_k, rag_type):
 
     return relevant_docs
 
-def retrieve_process_from_RAG(conn, query, top_k, rag_type):
-    relevant_docs = []
-    if rag_type == 'kendra':
-        rel_docs = retrieve_from_kendra(query=query, top_k=top_k)      
-        print('rel_docs (kendra): '+json.dumps(rel_docs))
+# retrieval cache: in-process LRU and a shared tier in DynamoDB. The key has the generation of the index 
+# which is bumped whenever a document is uploaded, so that stale results are not used.
+retrievalCacheTableName = os.environ.get('retrievalCacheTableName', '')
+retrievalCacheEndpoint = os.environ.get('retrievalCacheEndpoint')  # e.g. http://localhost:8000 for DynamoDB Local
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('retrievalCacheSize', '256'))  # entries
+RETRIEVAL_CACHE_TTL = int(os.environ.get('retrievalCacheTTL', '3600'))  # seconds
+GENERATION_REFRESH_INTERVAL = 10  # seconds
+KENDRA_INDEXING_WINDOW = int(os.environ.get('kendraIndexingWindow', '300'))  # seconds which Kendra may take to index an uploaded document
+KENDRA_CACHE_TTL = int(os.environ.get('kendraCacheTTL', '60'))  # seconds, for the results of Kendra within the indexing window
+GENERATION_KEY = '#generation'
+retrieval_cache_lock = threading.Lock()
+retrieval_cache = OrderedDict()  # key -> (expiration time, docs)
+retrieval_cache_counter = dict()  # rag_type -> counters
+retrieval_cache_client = None
+index_generation = {
+    'generation': 0,
+    'updated_at': 0.0,
+    'checked_at': 0.0
+}
+
+def get_retrieval_cache_client():
+    global retrieval_cache_client
+    if retrieval_cache_client is None:
+        retrieval_cache_client = boto3.client('dynamodb', endpoint_url=retrievalCacheEndpoint)
+    return retrieval_cache_client
+
+def get_index_generation():
+    if not retrievalCacheTableName:
+        return index_generation['generation']
+    
+    if time.time() - index_generation['checked_at'] > GENERATION_REFRESH_INTERVAL:
+        try:
+            resp = get_retrieval_cache_client().get_item(
+                TableName=retrievalCacheTableName,
+                Key={'cache_key': {'S': GENERATION_KEY}},
+                ConsistentRead=True
+            )
+            if 'Item' in resp:
+                index_generation['generation'] = int(resp['Item']['generation']['N'])
+                if 'updated_at' in resp['Item']:
+                    index_generation['updated_at'] = float(resp['Item']['updated_at']['N'])
+            index_generation['checked_at'] = time.time()
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+    return index_generation['generation']
+
+def bump_index_generation():
+    now = time.time()
+    index_generation['updated_at'] = now
+    if retrievalCacheTableName:
+        try:
+            resp = get_retrieval_cache_client().update_item(
+                TableName=retrievalCacheTableName,
+                Key={'cache_key': {'S': GENERATION_KEY}},
+                UpdateExpression='ADD generation :one SET updated_at = :now',
+                ExpressionAttributeValues={':one': {'N': '1'}, ':now': {'N': str(now)}},
+                ReturnValues='UPDATED_NEW'
+            )
+            index_generation['generation'] = int(resp['Attributes']['generation']['N'])
+            index_generation['checked_at'] = time.time()
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
     else:
-        rel_docs = retrieve_from_vectorstore(query=query, top_k=top_k, rag_type=rag_type)
-        print(f'rel_docs ({rag_type}): '+json.dumps(rel_docs))
+        index_generation['generation'] += 1
     
-    if(len(rel_docs)>=1):
-        for doc in rel_docs:
-            relevant_docs.append(doc)    
+    with retrieval_cache_lock:
+        retrieval_cache.clear()
+    print('generation of index: ', index_generation['generation'])
+
+def get_retrieval_cache_key(query, top_k, rag_type, generation):
+    normalized_query = ' '.join(query.lower().split())
+    return hashlib.sha256(f"{generation}\n{rag_type}\n{top_k}\n{normalized_query}".encode('utf-8')).hexdigest()
+
+def count_retrieval_cache(rag_type, result):
+    with retrieval_cache_lock:
+        counter = retrieval_cache_counter.setdefault(rag_type, {'hit': 0, 'shared_hit': 0, 'miss': 0})
+        counter[result] += 1
+    print(f'retrieval cache ({rag_type}): {counter}')
+
+def get_retrieval_cache(key, rag_type):
+    with retrieval_cache_lock:
+        item = retrieval_cache.get(key)
+        if item is not None:
+            if item[0] > time.time():
+                retrieval_cache.move_to_end(key)
+                docs = json.loads(item[1])
+            else:
+                del retrieval_cache[key]
+                item = None
+    if item is not None:
+        count_retrieval_cache(rag_type, 'hit')
+        return docs
+
+    # faiss is different per container, so only the in-process tier is used
+    if retrievalCacheTableName and rag_type != 'faiss':
+        try:
+            resp = get_retrieval_cache_client().get_item(
+                TableName=retrievalCacheTableName,
+                Key={'cache_key': {'S': key}}
+            )
+            if 'Item' in resp and int(resp['Item']['ttl']['N']) > time.time():
+                put_retrieval_cache_to_memory(key, int(resp['Item']['ttl']['N']), resp['Item']['docs']['S'])
+                count_retrieval_cache(rag_type, 'shared_hit')
+                return json.loads(resp['Item']['docs']['S'])
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+
+    count_retrieval_cache(rag_type, 'miss')
+    return None
+
+def put_retrieval_cache_to_memory(key, expiration, value):
+    with retrieval_cache_lock:
+        retrieval_cache[key] = (expiration, value)
+        retrieval_cache.move_to_end(key)
+        while len(retrieval_cache) > RETRIEVAL_CACHE_SIZE:
+            retrieval_cache.popitem(last=False)
+
+def get_retrieval_cache_ttl(rag_type):
+    # Kendra indexes the uploaded document asynchronously after the generation was bumped, 
+    # so its results in the window may not have the document yet
+    if rag_type == 'kendra' and time.time() - index_generation['updated_at'] < KENDRA_INDEXING_WINDOW:
+        return KENDRA_CACHE_TTL
+    return RETRIEVAL_CACHE_TTL
+
+def put_retrieval_cache(key, rag_type, docs):
+    expiration = int(time.time()) + get_retrieval_cache_ttl(rag_type)
+    value = json.dumps(docs)
+    put_retrieval_cache_to_memory(key, expiration, value)
+
+    if retrievalCacheTableName and rag_type != 'faiss':
+        try:
+            get_retrieval_cache_client().put_item(
+                TableName=retrievalCacheTableName,
+                Item={
+                    'cache_key': {'S': key},
+                    'rag_type': {'S': rag_type},
+                    'docs': {'S': value},
+                    'ttl': {'N': str(expiration)}
+                }
+            )
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+
+def retrieve_from_RAG(query, top_k, rag_type):
+    start_time = time.time()
+    key = get_retrieval_cache_key(query, top_k, rag_type, get_index_generation())
+    rel_docs = get_retrieval_cache(key, rag_type)
+    if rel_docs is None:
+        if rag_type == 'kendra':
+            rel_docs = retrieve_from_kendra(query=query, top_k=top_k)      
+        else:
+            rel_docs = retrieve_from_vectorstore(query=query, top_k=top_k, rag_type=rag_type)
+        put_retrieval_cache(key, rag_type, rel_docs)
+    print(f'rel_docs ({rag_type}): '+json.dumps(rel_docs))
+    print(f'processing time for {rag_type}: ', str(time.time() - start_time))
     
-    conn.send(relevant_docs)
-    conn.close()
+    return rel_docs
+
+# retrieval is mostly network I/O, so every RAG source runs on a shared thread pool
+RETRIEVAL_TIMEOUT = float(os.environ.get('retrievalTimeout', '10'))  # seconds for each RAG source
+retrieval_executor = ThreadPoolExecutor(max_workers=max(8, 4*len(capabilities)), thread_name_prefix='rag')
+
+# the retrieval deadline is derived from the remaining time of the lambda, keeping time for the generation
+RESERVED_TIME_FOR_GENERATION = float(os.environ.get('reservedTimeForGeneration', '60'))  # seconds
+MIN_RETRIEVAL_TIMEOUT = 1.0
+
+def get_retrieval_timeout(lambda_deadline):
+    if lambda_deadline is None:
+        return RETRIEVAL_TIMEOUT
+    remaining_time = lambda_deadline - time.time() - RESERVED_TIME_FOR_GENERATION
+    return max(MIN_RETRIEVAL_TIMEOUT, min(RETRIEVAL_TIMEOUT, remaining_time))
+
+def retrieve_from_multiple_RAG(query, top_k, timeout=RETRIEVAL_TIMEOUT):
+    """Retrieves from every RAG source concurrently. Results of a source which fails or is slower than
+    the timeout are dropped, and the results from the other sources are returned."""
+    start_time = time.time()
+    futures = dict()
+    finished = dict()  # rag_type -> latency which is recorded when each source is completed
+    for rag_type in capabilities:
+        future = retrieval_executor.submit(retrieve_from_RAG, query, top_k, rag_type)
+        future.add_done_callback(lambda f, rag_type=rag_type: finished.setdefault(rag_type, round(time.time() - start_time, 3)))
+        futures[future] = rag_type
+    
+    done, not_done = wait(futures, timeout=timeout)
 
-def get_answer_using_RAG(chat, text, conv_type, connectionId, requestId, bedrock_embedding):
+    relevant_docs = []
+    latency = dict()
+    for future in futures:    # keep the order of capabilities
+        rag_type = futures[future]
+        if future in not_done:
+            latency[rag_type] = None
+            print(f'{rag_type} is not completed in {timeout}s. its result will be dropped')
+            future.add_done_callback(lambda f, rag_type=rag_type: print(f'late result from {rag_type} was dropped ({time.time() - start_time:.3f}s)'))
+            continue
+        
+        latency[rag_type] = finished.get(rag_type, round(time.time() - start_time, 3))
+        try:
+            rel_docs = future.result()
+        except Exception:
+            err_msg = traceback.format_exc()
+            print(f'error message ({rag_type}): ', err_msg)
+            continue
+        relevant_docs.extend(rel_docs)
+
+    print('latency of RAG sources: ', latency)
+    return relevant_docs, latency
+
+# semantic answer cache: answers of RAG are reused for questions whose revised question is close enough in embedding
+enableAnswerCache = os.environ.get('enableAnswerCache', 'true')
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('answerCacheThreshold', '0.95'))  # cosine similarity
+ANSWER_CACHE_TTL = int(os.environ.get('answerCacheTTL', '3600'))  # seconds
+ANSWER_CACHE_SIZE = int(os.environ.get('answerCacheSize', '256'))  # entries
+answer_cache_lock = threading.Lock()
+answer_cache = OrderedDict()  # hash of revised question -> cached answer
+answer_cache_counter = {
+    'hit': 0,
+    'miss': 0
+}
+
+def get_answer_cache(query_vector, generation):
+    now = time.time()
+    with answer_cache_lock:
+        for key in [key for key, item in answer_cache.items() if item['expiration'] <= now or item['generation'] != generation]:
+            del answer_cache[key]   # expired or the documents were changed
+        
+        selected = []
+        if answer_cache:
+            keys = list(answer_cache.keys())
+            vectors = np.vstack([answer_cache[key]['vector'] for key in keys])
+            scores, selected = rerank(query_vector, vectors, metric='cosine', threshold=ANSWER_CACHE_THRESHOLD, k=1)
+        
+        if not selected:
+            answer_cache_counter['miss'] += 1
+            print('answer cache: ', answer_cache_counter)
+            return None
+        
+        key = keys[selected[0][0]]
+        answer_cache.move_to_end(key)
+        answer_cache_counter['hit'] += 1
+        item = answer_cache[key]
+    print(f"answer cache: {answer_cache_counter}, similarity: {selected[0][1]:.3f}, cached question: {item['question']}")
+    return item['msg'], json.loads(item['docs'])
+
+def put_answer_cache(revised_question, query_vector, generation, msg, docs):
+    key = hashlib.sha256(' '.join(revised_question.lower().split()).encode('utf-8')).hexdigest()
+    with answer_cache_lock:
+        answer_cache[key] = {
+            'question': revised_question,
+            'vector': np.asarray(query_vector, dtype=np.float32),
+            'generation': generation,
+            'expiration': time.time() + ANSWER_CACHE_TTL,
+            'msg': msg,
+            'docs': json.dumps(docs)
+        }
+        answer_cache.move_to_end(key)
+        while len(answer_cache) > ANSWER_CACHE_SIZE:
+            answer_cache.popitem(last=False)
+
+def get_answer_using_RAG(text, conv_type, connectionId, requestId, bedrock_embedding, lambda_deadline=None):
     reference = ""
     start_time_for_revise = time.time()
 
     # revise question
-    revised_question = revise_question(connectionId, requestId, chat, text)    
+    revised_question = revise_question(connectionId, requestId, text)    
     print('revised_question: ', revised_question)
     if debugMessageMode=='true':
         sendDebugMessage(connectionId, requestId, '[Debug]: '+revised_question)
 
     print('processing time for revise question: ', str(time.time() - start_time_for_revise))
 
+    if enableAnswerCache == 'true':
+        query_vector = bedrock_embedding.embed_query_as_array(revised_question)
+        generation = get_index_generation()
+        
+        cached_answer = get_answer_cache(query_vector, generation)
+        if cached_answer is not None:
+            msg, selected_relevant_docs = cached_answer
+            isTyping(connectionId, requestId)
+            sendDeltaMessage(connectionId, requestId, msg)
+            if debugMessageMode=='true':
+                sendDebugMessage(connectionId, requestId, '[Debug]: the answer was delivered from the answer cache')
+
+            reference = ""
+            if len(selected_relevant_docs)>=1 and enableReference=='true':
+                reference = get_reference(selected_relevant_docs)
+            return msg, reference
+
     relevant_docs = []
     start_time_for_rag = time.time()
+    retrieval_timeout = get_retrieval_timeout(lambda_deadline)
+    print('retrieval timeout: ', retrieval_timeout)
     if useParallelRAG == 'false':
         print('start the sequencial processing for multiple RAG')
         for reg in capabilities:            
-            if reg == 'kendra':
-                rel_docs = retrieve_from_kendra(query=revised_question, top_k=top_k)      
-                print('rel_docs (kendra): '+json.dumps(rel_docs))
-            else:
-                rel_docs = retrieve_from_vectorstore(query=revised_question, top_k=top_k, rag_type=reg)
-                print(f'rel_docs ({reg}): '+json.dumps(rel_docs))
+            if time.time() - start_time_for_rag > retrieval_timeout:
+                print(f'retrieval deadline was expired. skip {reg}')
+                continue
+            rel_docs = retrieve_from_RAG(query=revised_question, top_k=top_k, rag_type=reg)
                 
             if(len(rel_docs)>=1):
                 for doc in rel_docs:
                     relevant_docs.append(doc)
     else:
         print('start the parallel processing for multiple RAG')
-            
-        processes = []
-        parent_connections = []
-        for rag in capabilities:
-            parent_conn, child_conn = Pipe()
-            parent_connections.append(parent_conn)
-            
-            process = Process(target=retrieve_process_from_RAG, args=(child_conn, revised_question, top_k, rag))
-            processes.append(process)
-
-        for process in processes:
-            process.start()
-            
-        for parent_conn in parent_connections:
-            rel_docs = parent_conn.recv()
-
-            if(len(rel_docs)>=1):
-                for doc in rel_docs:
-                    relevant_docs.append(doc)    
-
-        for process in processes:
-            process.join()
+        relevant_docs, latency = retrieve_from_multiple_RAG(revised_question, top_k, retrieval_timeout)
+        if debugMessageMode=='true':
+            sendDebugMessage(connectionId, requestId, f'[Debug]: latency of RAG sources: {latency}')
             
     print('processing time for RAG: ', str(time.time() - start_time_for_rag))
     #print('relevant_docs: ', relevant_docs)
@@ -1278,7 +2936,10 @@ def get_answer_using_RAG(chat, text, conv_type, connectionId, requestId, bedrock
     print('relevant_context: ', relevant_context)
 
     # query using RAG context
-    msg = query_using_RAG_context(connectionId, requestId, chat, relevant_context, revised_question)
+    msg = query_using_RAG_context(connectionId, requestId, relevant_context, revised_question)
+
+    if enableAnswerCache == 'true' and msg:
+        put_answer_cache(revised_question, query_vector, generation, msg, selected_relevant_docs)
 
     reference = ""
     if len(selected_relevant_docs)>=1 and enableReference=='true':
@@ -1313,7 +2974,272 @@ def create_metadata(bucket, key, meta_prefix, s3_prefix, uri, category, document
         print('error message: ', err_msg)        
         raise Exception ("Not able to create meta file")
 
-def getResponse(connectionId, jsonBody):
+# manifest of uploaded documents which is addressed by the content. The chunks, the summary and the embeddings are kept
+# per content, so an unchanged file is not extracted, summarized and indexed again. Manifests are placed next to the
+# metadata of kendra, but kendra doesn't crawl them since they are out of the inclusion prefix of the data source.
+enableManifest = os.environ.get('enableManifest', 'true')
+MANIFEST_PREFIX = 'metadata/manifest'
+
+def get_content_hash(s3_file_name):
+    # the ETag is the digest of the content, so the object doesn't need to be read
+    try:
+        response = s3.head_object(Bucket=s3_bucket, Key=s3_prefix+'/'+s3_file_name)
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return None
+    etag = response['ETag'].strip('"')
+    return hashlib.sha256(f"{etag}:{response['ContentLength']}".encode('utf-8')).hexdigest()
+
+def get_manifest_name_key(s3_file_name):
+    # a pointer from the name of file to the manifest of its latest content
+    return MANIFEST_PREFIX+'/names/'+s3_prefix+'/'+s3_file_name+'.json'
+
+def read_json_from_s3(key):
+    try:
+        response = s3.get_object(Bucket=s3_bucket, Key=key)
+        return json.loads(response['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return None
+
+def load_manifest(content_hash):
+    return read_json_from_s3(MANIFEST_PREFIX+'/'+content_hash+'.json')
+
+def load_previous_manifest(s3_file_name):
+    pointer = read_json_from_s3(get_manifest_name_key(s3_file_name))
+    if pointer is None:
+        return None
+    return load_manifest(pointer['content_hash'])
+
+def get_manifest_chunks(docs):
+    chunks = []
+    for doc in docs:
+        metadata = {k: v for k, v in doc.metadata.items() if k not in ('name', 'uri')}
+        chunks.append({
+            'hash': hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest(),
+            'text': doc.page_content,
+            'metadata': metadata
+        })
+    return chunks
+
+def create_manifest(content_hash, s3_file_name, file_type, chunks, summary):
+    return {
+        'content_hash': content_hash,
+        'name': s3_file_name,
+        'file_type': file_type,
+        'created_at': int(time.time()),
+        'summary': summary,
+        'chunks': chunks,
+        'embeddings': None,  # {'model_id', 'key', 'dimension'} of the npy object
+        'indexed': []        # names of file which were indexed with this content
+    }
+
+def get_documents_from_manifest(manifest, s3_file_name):
+    uri = path+parse.quote(s3_file_name)
+    for chunk in manifest['chunks']:
+        metadata = {
+            'name': s3_file_name,
+            'uri': uri
+        }
+        metadata.update(chunk['metadata'])
+        yield Document(
+            page_content=chunk['text'],
+            metadata=metadata
+        )
+
+def load_manifest_embeddings(manifest, bedrock_embedding):
+    """Puts the embeddings of the manifest into the embedding cache, so only new chunks are embedded by Bedrock."""
+    embeddings = manifest.get('embeddings')
+    if not embeddings or embeddings['model_id'] != bedrock_embedding.model_id:
+        return 0
+
+    try:
+        response = s3.get_object(Bucket=s3_bucket, Key=embeddings['key'])
+        vectors = np.load(io.BytesIO(response['Body'].read()), allow_pickle=False)
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        return 0
+
+    if len(vectors) != len(manifest['chunks']):
+        print('embeddings of the manifest are not matched with chunks')
+        return 0
+
+    with embedding_cache_lock:
+        for chunk, vector in zip(manifest['chunks'], vectors):
+            put_embedding_to_memory(get_embedding_key(embeddings['model_id'], chunk['text']), vector.copy())
+    return len(vectors)
+
+def save_manifest(manifest, vectors=None, model_id=None):
+    content_hash = manifest['content_hash']
+    try:
+        if vectors is not None:  # vectors can be memory-mapped, so they are written through a file
+            key = MANIFEST_PREFIX+'/'+content_hash+'.npy'
+            filename = '/tmp/'+content_hash+'.npy'
+            try:
+                np.save(filename, np.asarray(vectors, dtype=np.float32), allow_pickle=False)
+                s3.upload_file(filename, s3_bucket, key)
+            finally:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            manifest['embeddings'] = {
+                'model_id': model_id,
+                'key': key,
+                'dimension': int(vectors.shape[1])
+            }
+
+        s3.put_object(
+            Body=json.dumps(manifest),
+            Bucket=s3_bucket,
+            Key=MANIFEST_PREFIX+'/'+content_hash+'.json'
+        )
+        s3.put_object(
+            Body=json.dumps({'content_hash': content_hash}),
+            Bucket=s3_bucket,
+            Key=get_manifest_name_key(manifest['name'])
+        )
+        print('manifest: ', content_hash)
+    except Exception:  # the manifest is a cache, so the upload is not failed
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+
+# the uploaded document is written into every sink. Chunks are embedded and written by batches while the document is read,
+# so the chunks and the embeddings of a large document are not kept in memory at once. With useParallelUpload, the sinks
+# are written concurrently and the next batch is embedded while the previous one is written.
+UPLOAD_TIMEOUT = float(os.environ.get('uploadTimeout', '120'))  # seconds for each sink
+DOCUMENT_BATCH_SIZE = int(os.environ.get('documentBatchSize', '500'))  # chunks which are embedded and written at once
+upload_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='upload')
+
+def batch_documents(docs, size=DOCUMENT_BATCH_SIZE):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def start_upload(connectionId, requestId, bedrock_embedding, object, documentId, userId, category, meta_prefix):
+    upload = {
+        'connectionId': connectionId,
+        'requestId': requestId,
+        'bedrock_embedding': bedrock_embedding,
+        'object': object,
+        'documentId': documentId,
+        'userId': userId,
+        'category': category,
+        'meta_prefix': meta_prefix,
+        'start_time': time.time(),
+        'futures': dict(),  # future -> sink
+        'results': dict()   # sink -> 'success', 'failure' or 'timeout'
+    }
+
+    if useParallelUpload == 'false':
+        print('upload to kendra: ', object)
+        store_document_for_kendra(path, object, documentId)  # store the object into kendra
+    else:
+        # kendra and metadata don't need embeddings, so they start before embedding
+        upload['futures'][upload_executor.submit(store_document_for_kendra, path, object, documentId)] = 'kendra'
+        upload['futures'][upload_executor.submit(create_metadata, bucket=s3_bucket, key=object, meta_prefix=meta_prefix, s3_prefix=s3_prefix, uri=path+parse.quote(object), category=category, documentId=documentId)] = 'metadata'
+    return upload
+
+def collect_upload_results(upload, futures):
+    """Waits for the futures of sinks until the timeout of the upload. A sink which was failed is not written any more."""
+    connectionId, requestId, object = upload['connectionId'], upload['requestId'], upload['object']
+    done, not_done = wait(futures, timeout=max(0, UPLOAD_TIMEOUT - (time.time() - upload['start_time'])))
+    for future in futures:
+        sink = upload['futures'].pop(future)
+        elapsed_time = time.time() - upload['start_time']
+        if future in not_done:
+            print(f'{sink} is not completed in {UPLOAD_TIMEOUT}s')
+            upload['results'][sink] = 'timeout'
+            sendDebugMessage(connectionId, requestId, f"uploading {object} into {sink} was not completed in {UPLOAD_TIMEOUT}s")
+            continue
+        try:
+            future.result()
+            upload['results'].setdefault(sink, 'success')
+        except Exception:
+            err_msg = traceback.format_exc()
+            print(f'error message ({sink}): ', err_msg)
+            upload['results'][sink] = 'failure'
+            sendDebugMessage(connectionId, requestId, f"{object} was not uploaded into {sink} ({elapsed_time:.2f}s)")
+
+def upload_document_batch(upload, docs):
+    """Embeds a batch of chunks and writes it into opensearch and faiss. Returns (text, embedding) pairs, or None if embedding was failed."""
+    bedrock_embedding = upload['bedrock_embedding']
+    if useParallelUpload == 'false':  # a failure of a sink raises an exception
+        text_embeddings, metadatas = embed_documents_once(bedrock_embedding, docs)
+
+        print('upload to faiss: ', upload['object'])
+        store_document_for_faiss(text_embeddings, metadatas, bedrock_embedding)
+
+        print('upload to opensearch: ', upload['object'])
+        store_document_for_opensearch(bedrock_embedding, text_embeddings, metadatas, upload['userId'], upload['documentId'])
+        return text_embeddings
+
+    if 'embedding' in upload['results']:  # the rest of the document is not embedded after a failure
+        return None
+    try:
+        text_embeddings, metadatas = embed_documents_once(bedrock_embedding, docs)
+    except Exception:
+        err_msg = traceback.format_exc()
+        print('error message: ', err_msg)
+        sendDebugMessage(upload['connectionId'], upload['requestId'], f"{upload['object']}: embedding was failed. It was not uploaded into opensearch and faiss.")
+        upload['results']['embedding'] = 'failure'
+        return None
+
+    # the previous batch is written before this one is submitted, so at most a batch is waiting for the sinks
+    collect_upload_results(upload, [future for future, sink in upload['futures'].items() if sink in ('opensearch', 'faiss')])
+    if upload['results'].get('opensearch', 'success') == 'success':
+        upload['futures'][upload_executor.submit(store_document_for_opensearch, bedrock_embedding, text_embeddings, metadatas, upload['userId'], upload['documentId'])] = 'opensearch'
+    if upload['results'].get('faiss', 'success') == 'success':
+        upload['futures'][upload_executor.submit(store_document_for_faiss, text_embeddings, metadatas, bedrock_embedding)] = 'faiss'
+    return text_embeddings
+
+def finish_upload(upload):
+    """Returns the results of sinks, or None for the sequential upload which raises an exception for a failure."""
+    object = upload['object']
+    if useParallelUpload == 'false':
+        create_metadata(bucket=s3_bucket, key=object, meta_prefix=upload['meta_prefix'], s3_prefix=s3_prefix, uri=path+parse.quote(object), category=upload['category'], documentId=upload['documentId'])
+        print('processing time: ', str(time.time() - upload['start_time']))
+        return None
+
+    collect_upload_results(upload, list(upload['futures']))
+    elapsed_time = time.time() - upload['start_time']
+    for sink, result in upload['results'].items():
+        if result == 'success':
+            sendDebugMessage(upload['connectionId'], upload['requestId'], f"{object} was uploaded into {sink} ({elapsed_time:.2f}s)")
+    
+    print(f"results of sinks: {upload['results']}, processing time: {elapsed_time}")
+    return upload['results']
+
+def read_document_in_batches(docs, upload=None, chunks=None, vectors_filename=None):
+    """Yields texts of docs while their batches are written by the upload, so a document is summarized and indexed in a pass.
+    Compact records of the chunks and their embeddings are kept for the manifest only if chunks and vectors_filename are given."""
+    vectors_file = open(vectors_filename, 'wb') if vectors_filename else None
+    try:
+        count = 0
+        for batch in batch_documents(docs):
+            count += len(batch)
+            if chunks is not None:
+                chunks.extend(get_manifest_chunks(batch))
+            if upload is not None:
+                text_embeddings = upload_document_batch(upload, batch)
+                if vectors_file is not None and text_embeddings is not None:
+                    np.asarray([vector for text, vector in text_embeddings], dtype=np.float32).tofile(vectors_file)
+            for doc in batch:
+                yield doc.page_content
+        print('docs size: ', count)
+    finally:
+        if vectors_file is not None:
+            vectors_file.close()
+
+def getResponse(connectionId, jsonBody, lambda_deadline=None):
     userId  = jsonBody['user_id']
     # print('userId: ', userId)
     requestId  = jsonBody['request_id']
@@ -1334,46 +3260,28 @@ def getResponse(connectionId, jsonBody):
             print('rag_type: ', rag_type)
 
     global vectorstore_opensearch, vectorstore_faiss, enableReference
-    global map_chain, memory_chain, isReady, debugMessageMode, selected_LLM
+    global memory_entry, memory_chain, isReady, debugMessageMode, selected_LLM
 
     reference = ""
 
-    # Multi-LLM
+    # Multi-LLM: LLM calls are routed per call, and embedding uses the best region at the moment
+    selected_LLM = select_LLM()
     profile = profile_of_LLMs[selected_LLM]
     bedrock_region =  profile['bedrock_region']
     modelId = profile['model_id']
     print(f'selected_LLM: {selected_LLM}, bedrock_region: {bedrock_region}, modelId: {modelId}')
     # print('profile: ', profile)
     
-    chat = get_chat(profile_of_LLMs, selected_LLM)    
     bedrock_embedding = get_embedding(profile_of_LLMs, selected_LLM)
         
     # allocate memory
-    if userId in map_chain:  
-        print('memory exist. reuse it!')        
-        memory_chain = map_chain[userId]
-        
-    else: 
-        print('memory does not exist. create new one!')
-        memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=10)
-        map_chain[userId] = memory_chain
-        
-        allowTime = getAllowTime()
-        load_chat_history(userId, allowTime)
+    memory_entry = get_memory_entry(userId)
+    memory_chain = memory_entry['memory']
+    reset_token_usage()
         
     # rag sources
     if conv_type == 'qa':
-        vectorstore_opensearch = OpenSearchVectorSearch(
-            index_name = "rag-index-*", # all
-            #index_name = 'rag-index-'+userId+'-*',
-            is_aoss = False,
-            ef_search = 1024, # 512(default)
-            m=48,
-            #engine="faiss",  # default: nmslib
-            embedding_function = bedrock_embedding,
-            opensearch_url=opensearch_url,
-            http_auth=(opensearch_account, opensearch_passwd), # http_auth=awsauth,
-        )
+        vectorstore_opensearch = get_opensearch_vectorstore(bedrock_embedding)
         print('isReady = ', isReady)
 
     start = int(time.time())    
@@ -1404,34 +3312,17 @@ def getResponse(connectionId, jsonBody):
             textCount = len(text.split())
             print(f"query size: {querySize}, words: {textCount}")
 
-            if text == 'enableReference':
-                enableReference = 'true'
-                msg  = "Referece is enabled"
-            elif text == 'disableReference':
-                enableReference = 'false'
-                msg  = "Reference is disabled"
-            elif text == 'enableDebug':
-                debugMessageMode = 'true'
-                msg  = "Debug messages will be delivered to the client."
-            elif text == 'disableDebug':
-                debugMessageMode = 'false'
-                msg  = "Debug messages will not be delivered to the client."
-            elif text == 'clearMemory':
-                memory_chain.clear()
-                map_chain[userId] = memory_chain
-                    
-                print('initiate the chat memory!')
-                msg  = "The chat memory was intialized in this session."
-            else:          
-                if conv_type == 'normal':      # normal
-                    msg = general_conversation(connectionId, requestId, chat, text)  
-                    
-                elif conv_type == 'qa':   # question & answering
-                    print(f'rag_type: {rag_type}')
-                    msg, reference = get_answer_using_RAG(chat, text, conv_type, connectionId, requestId, bedrock_embedding)
-                                                    
-                memory_chain.chat_memory.add_user_message(text)  # append new diaglog
-                memory_chain.chat_memory.add_ai_message(msg)
+            # control commands are served by handle_control_command before getResponse
+            if conv_type == 'normal':      # normal
+                msg = general_conversation(connectionId, requestId, text)  
+                
+            elif conv_type == 'qa':   # question & answering
+                print(f'rag_type: {rag_type}')
+                msg, reference = get_answer_using_RAG(text, conv_type, connectionId, requestId, bedrock_embedding, lambda_deadline)
+                                                
+            memory_chain.chat_memory.add_user_message(text)  # append new diaglog
+            memory_chain.chat_memory.add_ai_message(msg)
+            update_memory_store(userId)
                 
         elif type == 'document':
             isTyping(connectionId, requestId)
@@ -1440,115 +3331,216 @@ def getResponse(connectionId, jsonBody):
             file_type = object[object.rfind('.')+1:len(object)]            
             print('file_type: ', file_type)
 
-            if file_type == 'csv':
-                docs = load_csv_document(object)
-                texts = []
-                for doc in docs:
-                    texts.append(doc.page_content)
-                print('texts: ', texts)
+            docs = None
+            manifest = None
+            content_hash = None
+            if enableManifest == 'true' and file_type in ('csv', 'pdf', 'txt', 'pptx', 'docx'):
+                content_hash = get_content_hash(object)
+                if content_hash:
+                    manifest = load_manifest(content_hash)
 
-                msg = get_summary(chat, texts)
+            if manifest is not None:  # the same content was uploaded before
+                print('manifest was found: ', content_hash)
+                docs = get_documents_from_manifest(manifest, object)
+                msg = manifest['summary']
+
+            elif file_type == 'csv':  # rows are read from the stream of the object while they are indexed
+                docs = load_csv_document(object)
 
             elif file_type == 'pdf' or file_type == 'txt' or file_type == 'pptx' or file_type == 'docx':
-                texts = load_document(file_type, object)
-
-                docs = []
-                for i in range(len(texts)):
-                    docs.append(
-                        Document(
-                            page_content=texts[i],
-                            metadata={
-                                'name': object,
-                                # 'page':i+1,
-                                'uri': path+parse.quote(object)
-                            }
-                        )
-                    )        
-                print('docs[0]: ', docs[0])    
-                print('docs size: ', len(docs))
-
-                msg = get_summary(chat, texts)
+                docs = load_document(file_type, object)
             else:
                 msg = "uploaded file: "+object
-                                
-            if conv_type == 'qa':
-                start_time = time.time()
+            
+            upload = None
+            if conv_type == 'qa' and manifest is not None and object in manifest['indexed']:
+                print('the file was not changed. skip indexing: ', object)
+
+            elif conv_type == 'qa':
+                if content_hash and docs is not None:
+                    # embeddings of the same content or the previous version of the file are reused
+                    previous = manifest if manifest is not None and manifest['embeddings'] else load_previous_manifest(object)
+                    if previous is not None:
+                        print('reused embeddings: ', load_manifest_embeddings(previous, bedrock_embedding))
+                
                 category = "upload"
                 documentId = "upload" + "-" + object
-                if useParallelUpload == 'false':                    
-                    print('upload to kendra: ', object)           
-                    store_document_for_kendra(path, object, documentId)  # store the object into kendra
-
-                    print('upload to faiss: ', object)                                                   
-                    if isReady == False:   
-                        embeddings = bedrock_embedding
-                        vectorstore_faiss = FAISS.from_documents( # create vectorstore from a document
-                            docs,  # documents
-                            embeddings  # embeddings
-                        )
-                        isReady = True
-                    else:
-                        store_document_for_faiss(docs, vectorstore_faiss)
-
-                    print('upload to opensearch: ', object)
-                    store_document_for_opensearch(bedrock_embedding, docs, userId, documentId)
-                    
-                else:                    
-                    p1 = Process(target=store_document_for_kendra, args=(path, object, documentId,))
-                    p1.start(); p1.join()
-                    
-                    if file_type == 'pdf' or file_type == 'txt' or file_type == 'csv' or file_type == 'pptx' or file_type == 'docx':
-                        # opensearch
-                        p2 = Process(target=store_document_for_opensearch, args=(bedrock_embedding, docs, userId, documentId,))
-                        p2.start(); p2.join()
-
-                        # faiss
-                        if isReady == False:   
-                            embeddings = bedrock_embedding
-                            vectorstore_faiss = FAISS.from_documents( # create vectorstore from a document
-                                docs,  # documents
-                                embeddings  # embeddings
-                            )
-                            isReady = True
-                        else: 
-                            vectorstore_faiss.add_documents(docs)       
-                
                 meta_prefix = "metadata"
-                create_metadata(bucket=s3_bucket, key=object, meta_prefix=meta_prefix, s3_prefix=s3_prefix, uri=path+parse.quote(object), category=category, documentId=documentId)
-                        
-                print('processing time: ', str(time.time() - start_time))
+                upload = start_upload(connectionId, requestId, bedrock_embedding, object, documentId, userId, category, meta_prefix)
+
+            # the document is read once while it is summarized and indexed by batches.
+            # Only the manifest keeps the chunks, and their embeddings are spilled into a file for it.
+            chunks = [] if manifest is None and content_hash else None
+            vectors_filename = None
+            if upload is not None and content_hash and docs is not None and (manifest is None or not manifest['embeddings']):
+                vectors_filename = '/tmp/'+content_hash+'.f32'
+            try:
+                if docs is not None:
+                    texts = read_document_in_batches(docs, upload, chunks, vectors_filename)
+                    if manifest is None:
+                        msg = get_summary(texts)
+                    else:  # the summary of the manifest is used
+                        deque(texts, maxlen=0)
+
+                if manifest is None and content_hash:
+                    manifest = create_manifest(content_hash, object, file_type, chunks, msg)
+                    if conv_type != 'qa':
+                        save_manifest(manifest)
+                
+                if upload is not None:
+                    results = finish_upload(upload)
+                    bump_index_generation()  # invalidate the cached retrieval results
+
+                    # the file is recorded as indexed only if every sink succeeded, so a failed upload can be tried again
+                    isIndexed = results is None or all(result == 'success' for result in results.values())
+                    if manifest is not None and isIndexed:
+                        vectors = None
+                        if vectors_filename and manifest['chunks']:
+                            vectors = np.memmap(vectors_filename, dtype=np.float32, mode='r').reshape(len(manifest['chunks']), -1)
+                        manifest['indexed'].append(object)
+                        save_manifest(manifest, vectors, bedrock_embedding.model_id)
+                    elif manifest is not None:
+                        print('some of sinks were failed. the file is not recorded as indexed: ', results)
+            finally:
+                if vectors_filename and os.path.exists(vectors_filename):
+                    os.remove(vectors_filename)
                         
         elapsed_time = int(time.time()) - start
         print("total run time(sec): ", elapsed_time)        
         #print('msg+reference: ', msg+reference)
 
+        print('token usage: ', token_usage)
+        if debugMessageMode=='true' and type == 'text':
+            sendDebugMessage(connectionId, requestId, f"token usage: {token_usage}")
+
         item = {
             'user_id': {'S':userId},
             'request_id': {'S':requestId},
             'request_time': {'S':requestTime},
             'type': {'S':type},
             'body': {'S':body},
-            'msg': {'S':msg+reference}
+            'msg': {'S':msg+reference},
+            'token_usage': {'M': {k: {'N': str(v)} for k, v in token_usage.items()}}
         }
-        client = boto3.client('dynamodb')
+        put_call_log(item)  # written after the answer was delivered
+
+    return msg, reference
+
+# control commands are served before getResponse without LLM and retrieval. Only clearMemory writes the call log.
+def enable_reference(userId, requestTime):
+    global enableReference
+    enableReference = 'true'
+    return "Referece is enabled"
+
+def disable_reference(userId, requestTime):
+    global enableReference
+    enableReference = 'false'
+    return "Reference is disabled"
+
+def enable_debug(userId, requestTime):
+    global debugMessageMode
+    debugMessageMode = 'true'
+    return "Debug messages will be delivered to the client."
+
+def disable_debug(userId, requestTime):
+    global debugMessageMode
+    debugMessageMode = 'false'
+    return "Debug messages will not be delivered to the client."
+
+def clear_memory(userId, requestTime):
+    with memory_store_lock:
+        entry = memory_store.get(userId)
+    if entry is None:  # the memory doesn't need to be loaded since it is cleared
+        put_memory_entry(userId, ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=MEMORY_MAX_DIALOGS), "")
+    else:
+        entry['memory'].clear()
+        entry['summary'] = ""
+        update_memory_store(userId)
+    
+    # an empty snapshot which is newer than the cleared dialogs and the summary in the call log, 
+    # so they are not loaded again in another container or after the memory was evicted
+    save_memory_snapshot(userId, requestTime)
+    
+    print('initiate the chat memory!')
+    return "The chat memory was intialized in this session."
+
+control_commands = {
+    'enableReference': enable_reference,
+    'disableReference': disable_reference,
+    'enableDebug': enable_debug,
+    'disableDebug': disable_debug,
+    'clearMemory': clear_memory
+}
+
+def handle_control_command(connectionId, jsonBody):
+    """Returns True if the message was a control command and it was served."""
+    if jsonBody.get('type') != 'text':
+        return False
+    command = control_commands.get(jsonBody.get('body'))
+    if command is None:
+        return False
+    
+    try:
+        msg = command(jsonBody['user_id'], jsonBody['request_time'])
+        sendResultMessage(connectionId, jsonBody['request_id'], msg)
+    finally:
+        flush_call_log()
+    return True
+
+# warm-up on $connect: the memory of the user and the connections to the best region are prepared before the first question
+enableWarmup = os.environ.get('enableWarmup', 'false')
+warm_connections = OrderedDict()   # connectionId -> time when it was warmed up
+
+def expire_warm_connections(now):
+    # $disconnect may be delivered to another container, so the connections are bounded like the memory store
+    while warm_connections:
+        connectionId, warmed_at = next(iter(warm_connections.items()))
+        if len(warm_connections) <= MEMORY_STORE_MAX_USERS and now - warmed_at <= MEMORY_STORE_TTL:
+            break
+        del warm_connections[connectionId]
+
+def warm_up(connectionId, userId):
+    start_time = time.time()
+    expire_warm_connections(start_time)
+    if connectionId in warm_connections:
+        return
+    warm_connections[connectionId] = start_time
+
+    def run(name, func, *args):
         try:
-            resp =  client.put_item(TableName=callLogTableName, Item=item)
+            func(*args)
         except Exception:
             err_msg = traceback.format_exc()
-            print('error message: ', err_msg)
-            raise Exception ("Not able to write into dynamodb")        
-        #print('resp, ', resp)
+            print(f'warm-up of {name} failed: ', err_msg)
 
-    if selected_LLM >= len(profile_of_LLMs)-1:
-        selected_LLM = 0
-    else:
-        selected_LLM = selected_LLM + 1
-
-    return msg, reference
+    if userId:
+        run('memory', get_memory_entry, userId)
+    
+    def warm_up_bedrock():
+        index = select_LLM()
+        get_chat(profile_of_LLMs, index)
+        bedrock_embedding = get_embedding(profile_of_LLMs, index)
+        # a request opens the pooled connection. The text is embedded only once since it is cached afterwards.
+        bedrock_embedding.embed_query('warm-up')
+        
+        if 'opensearch' in capabilities:
+            run('opensearch', lambda: get_opensearch_vectorstore(bedrock_embedding).client.ping())
+    
+    run('bedrock', warm_up_bedrock)
+    if 'faiss' in capabilities:
+        run('faiss', check_faiss_snapshot)
+    if 'kendra' in capabilities:
+        run('kendra', lambda: get_kendra_client().describe_index(Id=kendraIndex))
+    
+    print(f'warm-up for {userId} ({connectionId}): ', str(time.time() - start_time))
 
 def lambda_handler(event, context):
     # print('event: ', event)
     
+    lambda_deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        lambda_deadline = time.time() + context.get_remaining_time_in_millis()/1000
+    
     msg = ""
     if event['requestContext']: 
         connectionId = event['requestContext']['connectionId']        
@@ -1556,8 +3548,12 @@ def lambda_handler(event, context):
         
         if routeKey == '$connect':
             print('connected!')
+            if enableWarmup == 'true':
+                userId = (event.get('queryStringParameters') or {}).get('user_id')
+                warm_up(connectionId, userId)
         elif routeKey == '$disconnect':
             print('disconnected!')
+            warm_connections.pop(connectionId, None)
         else:
             body = event.get("body", "")
             #print("data[0:8]: ", body[0:8])
@@ -1572,25 +3568,39 @@ def lambda_handler(event, context):
                 print('request body: ', json.dumps(jsonBody))
 
                 requestId  = jsonBody['request_id']
+                if handle_control_command(connectionId, jsonBody):
+                    return {
+                        'statusCode': 200
+                    }
+
                 try:
-                    msg, reference = getResponse(connectionId, jsonBody)
+                    try:
+                        msg, reference = getResponse(connectionId, jsonBody, lambda_deadline)
+
+                        print('msg+reference: ', msg+reference)
+                    except Exception:
+                        err_msg = traceback.format_exc()
+                        print('err_msg: ', err_msg)
+
+                        sendErrorMessage(connectionId, requestId, err_msg)    
+                        raise Exception ("Not able to send a message")
+                                        
+                    result = {
+                        'request_id': requestId,
+                        'msg': msg+reference,
+                        'status': 'completed'
+                    }
+                    #print('result: ', json.dumps(result))
+                    sendMessage(connectionId, result)
 
-                    print('msg+reference: ', msg+reference)
-                except Exception:
-                    err_msg = traceback.format_exc()
-                    print('err_msg: ', err_msg)
-
-                    sendErrorMessage(connectionId, requestId, err_msg)    
-                    raise Exception ("Not able to send a message")
-                                    
-                result = {
-                    'request_id': requestId,
-                    'msg': msg+reference,
-                    'status': 'completed'
-                }
-                #print('result: ', json.dumps(result))
-                sendMessage(connectionId, result)
+                    if jsonBody['type'] == 'text':  # older dialogs are summarized after the answer was delivered
+                        compress_history(jsonBody['user_id'], jsonBody['request_time'])
+                        save_memory_snapshot(jsonBody['user_id'], jsonBody['request_time'])
+                finally:
+                    flush_call_log()  # always before the container is frozen
 
     return {
         'statusCode': 200
     }
+
+print_init_profile()